@@ -8,14 +8,17 @@ Created on Wed Sep 20 13:19:53 2017
 @author: alex
 """
 
-from collections import deque, OrderedDict, namedtuple, Iterable
+from collections import deque, OrderedDict, namedtuple, ChainMap, Iterable
+import sys
+import re
+import builtins
 import itertools
-from types import SimpleNamespace
+import functools
+from contextlib import contextmanager
+from types import SimpleNamespace, ModuleType
 import hashlib
-from numbers import Number
 import numpy as np
 import scipy as sp
-import pandas as pd
 import logging
 logger = logging.getLogger(__file__)
 
@@ -31,12 +34,28 @@ except (NameError, ImportError):
     smttk_loaded = False
     from parameters import ParameterSet
     ParameterSetBase = ParameterSet
-from .utils import isinstance, flatten, strip_comments
+from .utils import isinstance, strip_comments
 
 ##########################
 # Module variables
 debug_store = {}
     # Functions can store values in here to help debugging
+_iterable_types = (list, tuple, set, frozenset, dict, str, bytes, np.ndarray)
+_noniterable_types = (int, float, bool, complex, type(None),
+                      np.int64, np.float64, np.bool_)
+    # Common types, for which `_is_iterable` can skip the ABC check
+
+def _is_iterable(obj):
+    """
+    Equivalent to `isinstance(obj, Iterable)`, but faster for common types.
+    """
+    objtype = type(obj)
+    if objtype in _iterable_types:
+        return True
+    elif objtype in _noniterable_types:
+        return False
+    else:
+        return builtins.isinstance(obj, Iterable)
 
 ##########################
 # Transformed parameters
@@ -46,6 +65,82 @@ import simpleeval
 import ast
 import operator
 
+# AST nodes which are evaluated by Python the same way as by the simpleeval
+# evaluator of `Transform`.
+# Attributes are further checked in `_is_compilable_transform`; calls are
+# only allowed for attributes (e.g. `np.log`), since simpleeval looks up
+# function names in a separate namespace.
+_compilable_nodes = (
+    ast.Expression, ast.Constant, ast.Name, ast.Load, ast.Attribute,
+    ast.Call, ast.keyword, ast.Subscript, ast.Slice,
+    ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.And, ast.Or,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Pow, ast.Mod,
+    ast.USub, ast.UAdd, ast.Not, ast.Invert,
+    ast.BitXor, ast.BitOr, ast.BitAnd,
+    ast.Eq, ast.NotEq, ast.Gt, ast.Lt, ast.GtE, ast.LtE,
+    ast.In, ast.NotIn, ast.Is, ast.IsNot)
+if hasattr(ast, 'Index'):
+    # Python < 3.9
+    _compilable_nodes += (ast.Index,)
+
+def _is_compilable_transform(tree, namespaces):
+    """
+    Return True if the parsed expression `tree` can be compiled and evaluated
+    with `eval`, giving the same result as with simpleeval.
+    Attributes are only allowed on modules from `namespaces` (e.g. `np.log`
+    or `sp.special.expit`): simpleeval first tries `obj[attr]`, which for
+    other objects (e.g. dicts) may differ from `getattr(obj, attr)`.
+    """
+    disallowed_attrs = getattr(simpleeval, 'DISALLOW_METHODS', ())
+    disallowed_prefixes = tuple(getattr(simpleeval, 'DISALLOW_PREFIXES', ('_',)))
+    for node in ast.walk(tree):
+        if not isinstance(node, _compilable_nodes):
+            return False
+        elif isinstance(node, ast.Attribute):
+            if (node.attr.startswith(disallowed_prefixes)
+                or node.attr in disallowed_attrs
+                or not isinstance(_resolve_attribute_value(node.value,
+                                                           namespaces),
+                                  ModuleType)):
+                return False
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Attribute):
+                return False
+    return True
+
+def _resolve_attribute_value(node, namespaces):
+    """
+    Return the object which `node` refers to, if it is a name in `namespaces`
+    or an attribute chain of modules starting from one (e.g. `sp.special`).
+    Otherwise return None.
+    """
+    if isinstance(node, ast.Name):
+        return namespaces.get(node.id)
+    elif isinstance(node, ast.Attribute):
+        obj = _resolve_attribute_value(node.value, namespaces)
+        if isinstance(obj, ModuleType):
+            return getattr(obj, node.attr, None)
+    return None
+
+# Maximum number of entries in each of the transform caches
+_transform_cache_size = 1024
+
+@functools.lru_cache(maxsize=_transform_cache_size)
+def _parse_transform(expr):
+    """
+    Parse the transform expression `expr` once, rather than on every call.
+    Return a tuple (AST, code object or None).
+    """
+    tree = ast.parse(expr, mode='eval')
+    # If the expression only uses constructs which Python evaluates the same
+    # way as simpleeval, compile it to a code object; evaluating it is much
+    # faster than walking the AST. Other expressions always use simpleeval.
+    code = (compile(tree, '<transform>', 'eval')
+            if _is_compilable_transform(tree, Transform.namespaces)
+            else None)
+    return tree.body, code
+
 class Transform:
     # Replace the "safe" operators with their standard forms
     # (simpleeval implements safe_add, safe_mult, safe_exp, which test their
@@ -59,21 +154,52 @@ class Transform:
     namespaces = {'np': np,
                   'sp': sp}
 
+    __slots__ = ('_xname', '_expr', '_is_identity', '_ast', '_code',
+                 '_initialized')
+
+    # Transforms are immutable and keep no state between calls, so instances
+    # can be shared between identical descriptions
+    @staticmethod
+    @functools.lru_cache(maxsize=_transform_cache_size)
+    def _cached_instance(cls, transform_desc):
+        return object.__new__(cls)
+
     def __new__(cls, *args, **kwargs):
         # Make calling Transform on a Transform instance just return the instance
         if len(args) > 0 and isinstance(args[0], Transform):
             # Don't return a new instance; just return this one
             return args[0]
+        elif len(args) > 0 and isinstance(args[0], str):
+            return cls._cached_instance(cls, args[0])
         else:
             return super().__new__(cls)
 
     def __init__(self, transform_desc):
         # No matter what we do in __new__, __init__ is called, so we need
-        # to check this again.
-        if not isinstance(transform_desc, Transform):
-            xname, expr = transform_desc.split('->')
-            self.xname = xname.strip()
-            self.expr = expr.strip()
+        # to check this again. Cached instances are already initialized.
+        if (not isinstance(transform_desc, Transform)
+            and not getattr(self, '_initialized', False)):
+            xname, sep, expr = transform_desc.partition('->')
+            if not sep or '->' in expr:
+                raise ValueError("Malformed transform description '{}'."
+                                 .format(transform_desc))
+            self._xname = xname.strip()
+            self._expr = expr.strip()
+            self._compile()
+
+    def _compile(self):
+        # Identity transforms (e.g. 'x -> x') don't need to be evaluated
+        self._is_identity = (self.expr == self.xname)
+        self._ast, self._code = _parse_transform(self.expr)
+        self._initialized = True
+
+    # Code objects can't be pickled, so only the description is stored;
+    # the expression is compiled again when unpickling.
+    def __getstate__(self):
+        return (self.xname, self.expr)
+    def __setstate__(self, state):
+        self._xname, self._expr = state
+        self._compile()
 
     def __str__(self):
         return self.desc
@@ -81,13 +207,23 @@ class Transform:
         return str(type(self)) + '(' + self.desc + ')'
 
     def __call__(self, x):
-        names = {self.xname: x}
-        names.update(self.namespaces)
+        if self._is_identity:
+            return x
+        # The argument is only stored in this call's names map, since the
+        # instance may be shared with other callers (possibly in other threads).
+        # Chaining to the class namespaces avoids copying them on every call.
+        names = ChainMap(self.namespaces, {self.xname: x})
         try:
-            res = simpleeval.simple_eval(
-                self.expr,
-                operators=Transform._operators,
-                names=names)
+            if self._code is not None:
+                try:
+                    return eval(self._code, {'__builtins__': {}}, names)
+                except NameError:
+                    # Let simpleeval produce a more helpful error message
+                    pass
+            evaluator = simpleeval.SimpleEval(
+                operators=Transform._operators, names=names)
+            evaluator.expr = self.expr  # Used in error messages
+            res = evaluator._eval(self._ast)
         except simpleeval.NameNotDefined as e:
             e.args = ((e.args[0] +
                        "\n\nThis may be due to a module function in the transform "
@@ -103,6 +239,14 @@ class Transform:
             raise
         return res
 
+    # Read-only, since instances are shared
+    @property
+    def xname(self):
+        return self._xname
+    @property
+    def expr(self):
+        return self._expr
+
     @property
     def desc(self):
         return self.xname + " -> " + self.expr
@@ -116,7 +260,7 @@ class MetaTransformedVar(type):
         if not( (orig is None) != (new is None) ):  #xor
             raise ValueError("Exactly one of `orig`, `new` must be specified.")
 
-        if desc is not None and all(s in desc for s in ['name', 'to', 'back']):
+        if desc is not None and all(s in desc for s in cls._transform_keys):
             # Standard way to make transformed variable by providing transform description
             var = TransformedVar.__new__(TransformedVar, desc, *args, orig=orig, new=new)
             var.__init__(desc, *args, orig=orig, new=new)
@@ -141,11 +285,40 @@ class TransformedVarBase(metaclass=MetaTransformedVar):
     depending on whether `desc` provides a transform.
     """
     TransformName = namedtuple('TransformName', ['orig', 'new'])
+    _transform_keys = ('name', 'to', 'back')
+        # Keys required for a complete transform description
+    __slots__ = ()
+
+    @classmethod
+    @functools.lru_cache(maxsize=_transform_cache_size)
+    def _get_name(cls, orig, new):
+        """Return the shared TransformName for the pair (`orig`, `new`)."""
+        if builtins.isinstance(orig, str):
+            orig = sys.intern(orig)
+        if builtins.isinstance(new, str):
+            new = sys.intern(new)
+        return cls.TransformName(orig, new)
+
+    @classmethod
+    @functools.lru_cache(maxsize=_transform_cache_size)
+    def _parse_name(cls, name_desc):
+        """
+        Return the TransformName for a name description (e.g. 'x -> logx').
+        """
+        orig, sep, new = name_desc.partition('->')
+        if not sep or '->' in new:
+            raise ValueError("Malformed transformation name description '{}'."
+                             .format(name_desc))
+        return cls._get_name(orig.strip(), new.strip())
 
     def __new__(cls, *args, **kwargs):
         return super().__new__(cls)
 
+# Allow pickle to find the nested namedtuple class
+TransformedVarBase.TransformName.__qualname__ = 'TransformedVarBase.TransformName'
+
 class TransformedVar(TransformedVarBase):
+    __slots__ = ('to', 'back', 'orig', 'new', 'names')
 
     # def __new__(cls, desc, *args, orig=None, new=None):
     #     # Required because of MetaTransformedVar
@@ -158,7 +331,7 @@ class TransformedVar(TransformedVarBase):
             Test to see if orig/new is a constant, callable or symbolic.
             Set the other orig/new to the same type.
         """
-        if not all(s in desc for s in ['to', 'back', 'name']):
+        if not all(s in desc for s in self._transform_keys):
             raise ValueError("Incomplete transform description")
         self.to = Transform(desc.to)
         self.back = Transform(desc.back)
@@ -172,7 +345,7 @@ class TransformedVar(TransformedVarBase):
             self.orig = self.back(new)
 
         # Set the variable names
-        self.names = self.TransformName(*[nm.strip() for nm in desc.name.split('->')])
+        self.names = self._parse_name(desc.name)
         if hasattr(self.orig, 'name'):
             if self.orig.name is None:
                 self.orig.name = self.names.orig
@@ -198,12 +371,13 @@ class TransformedVar(TransformedVarBase):
         orig: str
             Name to assign to self.orig
         """
-        self.names = self.TransformName(orig=orig, new=new)
+        self.names = self._get_name(orig, new)
         self.orig.name = orig
         self.new.name = new
 
 class NonTransformedVar(TransformedVarBase):
     """Provides an interface consistent with TransformedVar."""
+    __slots__ = ('to', 'back', 'orig', 'new', 'names')
 
     def __init__(self, desc, orig):
         """
@@ -224,13 +398,13 @@ class NonTransformedVar(TransformedVarBase):
         # Set name
         self.names = None
         if isinstance(desc, str):
-            self.names = self.TransformName(desc, desc)
+            self.names = self._get_name(desc, desc)
         elif desc is not None and 'name' in desc:
-            nametup = desc.name.split('->')
-            if len(nametup) == 1:
-                self.names = self.TransformName(nametup[0], nametup[0])
-            elif len(nametup) == 2:
-                self.names = self.TransformName(*nametup)
+            orig_name, sep, new_name = desc.name.partition('->')
+            if not sep:
+                self.names = self._get_name(orig_name, orig_name)
+            elif '->' not in new_name:
+                self.names = self._get_name(orig_name, new_name)
                 assert(self.names.new == self.names.orig)
             else:
                 raise ValueError("Malformed transformation name description '{}'."
@@ -262,7 +436,7 @@ class NonTransformedVar(TransformedVarBase):
         """
         if new is not None and new != orig:
             raise ValueError("For NonTransformedVar, the 'new' and 'orig' names must match.")
-        self.names = self.TransformName(orig=orig, new=orig)
+        self.names = self._get_name(orig, orig)
         if hasattr(self.orig, 'name') and self.orig.name is not None:
             self.orig.name = orig
 
@@ -289,6 +463,9 @@ _new_printoptions = {'1.14': ['floatmode', 'sign', 'legacy']}
     # Lists of printoptions keywords, keyed by the NumPy version where they were introduced
     # This allows removing keywords when using an older version
 _remove_whitespace_for_filenames = True
+_whitespace_table = {c: None for c in range(0x3001) if chr(c).isspace()}
+    # Translation table deleting the characters `str.split()` splits on
+    # (U+3000 is the last whitespace character in Unicode)
 _type_compress = OrderedDict((
     (np.floating, np.float64),
     (np.integer, np.int64)
@@ -314,11 +491,154 @@ def normalize_type(value):
     if isinstance(value, np.ndarray):
         for cmp_dtype, conv_dtype in _type_compress.items():
             if np.issubdtype(value.dtype, cmp_dtype):
-                return value.astype(conv_dtype)
+                # Don't copy arrays which already have the right type
+                return value.astype(conv_dtype, copy=False)
     # No conversion match was found: return value unchanged
     return value
 
-def digest(params, suffix=None, convert_to_arrays=True):
+def _digest_value(value):
+    """
+    Return the normalized form of `value` used to compute a digest: its own
+    digest if it provides one, otherwise `normalize_type(value)`.
+    """
+    if hasattr(value, 'digest'):
+        return value.digest() if hasattr(value.digest, '__call__') \
+            else value.digest
+    else:
+        return normalize_type(value)
+
+def _digest_repr(params):
+    """
+    Hash the string representation of a parameter set.
+    This is the historical method used by `digest` (`legacy=True`).
+    """
+    if (np.__version__ < '1.14'
+        and _filename_printoptions['legacy'] != '1.13'):
+        logger.warning(
+            "You are running Numpy v{}. Numpy's string representation "
+            "algorithm was changed in v.1.14, meaning that computed "
+            "filenames will not be consistent with those computed on "
+            "more up-to-date systems. To ensure consistent filenames, "
+            "either update to 1.14, or set  `mackelab_toolbox.parameters._filename_printoptions['legacy']` "
+            "to '1.13'. Note that setting the 'legacy' option may not "
+            "work in all cases.".format(np.__version__))
+    # Standardize the numpy print options, which affect output from str()
+    # If they are already set (e.g. within `get_filenames`), don't set
+    # them again
+    printoptions = _get_filename_printoptions()
+    current_printoptions = np.get_printoptions()
+    if all(current_printoptions.get(key) == value
+           for key, value in printoptions.items()):
+        return _hash_sorted_repr(params)
+    else:
+        with np.printoptions(**printoptions):
+            return _hash_sorted_repr(params)
+
+def _hash_sorted_repr(params):
+    # Implementation of `_digest_repr`, once print options are set
+    sorted_items = [(key, _digest_value(value))
+                    for key, value in _sorted_flat_items(params)]
+
+    # Now that the parameterset is standardized, hash its string repr
+    # This is formatted as the repr of an OrderedDict was up to Python 3.11,
+    # which is what filenames have always been computed from.
+    if len(sorted_items) > 0:
+        s = 'OrderedDict(' + repr(sorted_items) + ')'
+    else:
+        s = 'OrderedDict()'
+    debug_store['get_filename'] = {'hashed_string': s}
+    if _remove_whitespace_for_filenames:
+        # Removing whitespace makes the result more reliable; e.g. between
+        # v1.13 and v1.14 Numpy changed the amount of spaces between some elements
+        # (Equivalent to `''.join(s.split())`, without the intermediate list)
+        s = s.translate(_whitespace_table)
+    return hashlib.sha1(bytes(s, 'utf-8')).hexdigest()
+
+def _get_filename_printoptions():
+    """
+    Return `_filename_printoptions`, without the options that are not
+    supported in this Numpy version.
+    The result is cached, and only recomputed if `_filename_printoptions`
+    was modified.
+    """
+    global _filename_printoptions_cache
+    source, printoptions = _filename_printoptions_cache
+    if source != _filename_printoptions:
+        source = _filename_printoptions.copy()
+        printoptions = _filename_printoptions.copy()
+        for version in (v for v in _new_printoptions if v > np.__version__):
+            for key in _new_printoptions[version]:
+                del printoptions[key]
+        _filename_printoptions_cache = (source, printoptions)
+    return printoptions
+_filename_printoptions_cache = (None, None)
+
+def _sha1():
+    """
+    Return a new SHA-1 hash object. The hash is only used as a fingerprint,
+    so where possible we tell OpenSSL it isn't used for security.
+    """
+    try:
+        return hashlib.sha1(usedforsecurity=False)
+    except TypeError:
+        # `usedforsecurity` was added in Python 3.9
+        return hashlib.sha1()
+
+def _hash_update(h, key, value):
+    """
+    Feed a `(key, value)` pair to the hash object `h`.
+    """
+    h.update(key.encode('utf-8'))
+    h.update(b'\x00')
+    _hash_value(h, value)
+    h.update(b'\x00')
+
+def _hash_value(h, value):
+    """
+    Feed `value` to the hash object `h`.
+    Arrays are fed with their raw data (plus dtype and shape), which avoids
+    formatting them as strings. Containers are fed element by element, with
+    dicts and sets in sorted order so that the hash doesn't depend on their
+    iteration order. Other values are fed with their `repr`; NumPy scalars
+    are first converted to the equivalent Python scalar, since their `repr`
+    depends on the NumPy version.
+    """
+    if builtins.isinstance(value, np.generic):
+        value = value.item()
+    vtype = type(value)
+    if builtins.isinstance(value, np.ndarray) and value.dtype != object:
+        h.update(value.dtype.str.encode('utf-8'))
+        h.update(str(value.shape).encode('utf-8'))
+        # Pass a byte view of the data, to avoid the copy made by `tobytes()`
+        h.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8))
+    elif vtype is list or vtype is tuple:
+        h.update(b'[' if vtype is list else b'(')
+        for v in value:
+            _hash_value(h, v)
+            h.update(b'\x1f')
+        h.update(b']' if vtype is list else b')')
+    elif builtins.isinstance(value, dict):
+        h.update(b'{')
+        for k, v in sorted(value.items(), key=lambda item: repr(item[0])):
+            _hash_value(h, k)
+            h.update(b':')
+            _hash_value(h, v)
+            h.update(b'\x1f')
+        h.update(b'}')
+    elif vtype is set or vtype is frozenset:
+        h.update(b'{')
+        for r in sorted(repr(v.item() if builtins.isinstance(v, np.generic)
+                             else v)
+                        for v in value):
+            h.update(r.encode('utf-8'))
+            h.update(b'\x1f')
+        h.update(b'}')
+    else:
+        # Object arrays are also hashed with their repr, since their raw
+        # data are pointers.
+        h.update(repr(value).encode('utf-8'))
+
+def digest(params, suffix=None, convert_to_arrays=True, legacy=True):
     """
     Generate a unique name by hashing a parameter file.
 
@@ -332,7 +652,7 @@ def digest(params, suffix=None, convert_to_arrays=True):
     value of `debug_store['get_filename']['hashed_string']`. This module-wide
     stores the most recently hashed string representation of a parameter set.
     Filename hashes will be the same if and only if these string represenations
-    are the same.
+    are the same. (Only with `legacy=True`.)
 
     Parameters
     ----------
@@ -350,94 +670,130 @@ def digest(params, suffix=None, convert_to_arrays=True):
     convert_to_arrays: bool
         If true, the parameters are normalized by using the result of
         `params_to_arrays(params)` to calculate the filename.
+
+    legacy: bool
+        If true (default), the hash is computed from the string representation
+        of the parameters. This is how filenames have always been computed.
+        If false, arrays are hashed from their raw data, which is much faster
+        for large arrays, but produces different filenames.
+
+    See also
+    --------
+    digest_cache: Avoid rehashing the same parameter set.
     """
+    # Key for `_digest_cache`; computed before `params` is converted
+    cache_key = (id(params), convert_to_arrays, legacy)
+    orig_params = params
     if isinstance(params, dict):
         # TODO: Any reason this implicit conversion should throw a warning ?
         params = ParameterSet(params)
     if (not isinstance(params, (ParameterSetBase, str))
-        and isinstance(params, Iterable)):
+        and _is_iterable(params)):
         # Get a hash for each ParameterSet, and rehash them together
         basenames = [p.digest() if hasattr(p, 'digest')
-                     else digest(p, None, convert_to_arrays)
+                     else digest(p, None, convert_to_arrays, legacy)
                      for p in params]
         basename = hashlib.sha1(bytes(''.join(basenames), 'utf-8')).hexdigest()
         basename += '_'
 
+    elif _digest_cache is not None and cache_key in _digest_cache:
+        basename = _digest_cache[cache_key][1]
+
     else:
-        if not isinstance(params, ParameterSetBase):
-            logger.warning("'get_filename()' requires an instance of ParameterSet. "
-                           "Performing an implicit conversion.")
-            params = ParameterSet(params)
-        if convert_to_arrays:
-            # Standardize the parameters by converting them all to arrays
-            # -> `[1, 0]` and `np.array([1, 0])` should give same file name
-            params = params_to_arrays(params)
-        if params == '':
+        params = _normalize_for_digest(params, convert_to_arrays)
+        if params is None:
             basename = ""
         else:
-            if (np.__version__ < '1.14'
-                and _filename_printoptions['legacy'] != '1.13'):
-                logger.warning(
-                    "You are running Numpy v{}. Numpy's string representation "
-                    "algorithm was changed in v.1.14, meaning that computed "
-                    "filenames will not be consistent with those computed on "
-                    "more up-to-date systems. To ensure consistent filenames, "
-                    "either update to 1.14, or set  `mackelab_toolbox.parameters._filename_printoptions['legacy']` "
-                    "to '1.13'. Note that setting the 'legacy' option may not "
-                    "work in all cases.".format(np.__version__))
-            # Remove printoptions that are not supported in this Numpy version
-            printoptions = _filename_printoptions.copy()
-            for version in (v for v in _new_printoptions if v > np.__version__):
-                for key in _new_printoptions[version]:
-                    del printoptions[key]
-
-            # Standardize the numpy print options, which affect output from str()
-            stored_printoptions = np.get_printoptions()
-            np.set_printoptions(**printoptions)
-
-            # HACK Force dereferencing of '->' in my ParameterSet
-            #      Should be innocuous for normal ParameterSets
-            def dereference(paramset):
-                for key in paramset:
-                    paramset[key] = paramset[key]
-                    if isinstance(paramset[key], ParameterSetBase):
-                        dereference(paramset[key])
-            dereference(params)
-
-            # Standardize the parameters by converting them all to arrays
-            # -> `[1, 0]` and `np.array([1, 0])` should give same file name
-            # params = params_to_arrays(params)
-
-            # We need a sorted dictionary of parameters, so that the hash is consistent
-            # Also remove keys starting with '_'
-            # Types need to be normalized, because if we save values as Python
-            # plain types, this can throw away some Numpy type information.
-            # To make sure filenames are consistent when we read the parameters
-            # back, we use one type per Python type (1 for floats, 1 for ints)
-            flat_params = params.flatten()
-                # flatten avoids need to sort recursively
-            sorted_params = OrderedDict()
-            for key in sorted(flat_params):
-                if key[0] != '_':
-                    val = flat_params[key]
-                    if hasattr(val, 'digest'):
-                        sorted_params[key] = \
-                            val.digest() if hasattr(val.digest, '__call__') \
-                            else val.digest
-                    else:
-                        sorted_params[key] = normalize_type(val)
-
-            # Now that the parameterset is standardized, hash its string repr
-            s = repr(sorted_params)
-            debug_store['get_filename'] = {'hashed_string': s}
-            if _remove_whitespace_for_filenames:
-                # Removing whitespace makes the result more reliable; e.g. between
-                # v1.13 and v1.14 Numpy changed the amount of spaces between some elements
-                s = ''.join(s.split())
-            basename = hashlib.sha1(bytes(s, 'utf-8')).hexdigest()
+            if legacy:
+                basename = _digest_repr(params)
+            else:
+                h = _sha1()
+                _hash_params(h, params)
+                basename = h.hexdigest()
             basename += '_'
-            # Reset the saved print options
-            np.set_printoptions(**stored_printoptions)
+        if _digest_cache is not None:
+            # Keep a reference to the parameters, so their id is not reused
+            _digest_cache[cache_key] = (orig_params, basename)
+    return _append_suffix(basename, suffix)
+get_filename = digest
+
+_digest_cache = None
+    # Dictionary of computed digests, active only within `digest_cache`
+
+@contextmanager
+def digest_cache():
+    """
+    Within this context, `digest` remembers the hash of every parameter set
+    it computes, and returns it directly if the same object is digested again.
+    Parameter sets must therefore not be modified within the context.
+
+    >>> with digest_cache():
+    >>>     names = [get_filename(p) for p in param_sets]
+    """
+    global _digest_cache
+    outer_cache = _digest_cache
+    if outer_cache is None:
+        _digest_cache = {}
+    try:
+        yield
+    finally:
+        _digest_cache = outer_cache
+
+def _normalize_for_digest(params, convert_to_arrays):
+    """
+    Normalize `params` and return them as a parameter set, or `None`
+    if `params` is empty.
+    """
+    if not isinstance(params, ParameterSetBase):
+        logger.warning("'get_filename()' requires an instance of ParameterSet. "
+                       "Performing an implicit conversion.")
+        params = ParameterSet(params)
+    if convert_to_arrays:
+        # Standardize the parameters by converting them all to arrays
+        # -> `[1, 0]` and `np.array([1, 0])` should give same file name
+        params = params_to_arrays(params)
+    if params == '':
+        return None
+    # References ('->') are resolved when values are retrieved in
+    # `_sorted_nested_items`, so they don't need to be dereferenced here.
+    return params
+
+def _sorted_flat_items(params):
+    """
+    Iterate over `(key, value)` pairs of the flattened parameter set, in the
+    order of the sorted flattened keys, without building the flattened set.
+    Top-level keys starting with '_' are skipped.
+    """
+    # We need sorted parameters, so that the hash is consistent
+    # Also remove keys starting with '_'
+    # Types need to be normalized, because if we save values as Python
+    # plain types, this can throw away some Numpy type information.
+    # To make sure filenames are consistent when we read the parameters
+    # back, we use one type per Python type (1 for floats, 1 for ints)
+    return ((key, value) for key, value in _sorted_nested_items(params, '')
+            if key[0] != '_')
+
+def _sorted_nested_items(d, prefix):
+    # Nested sets are sorted as `key + '.'`, which is how all their flattened
+    # keys start; this makes the order the same as sorting flattened keys.
+    # Values are retrieved with `d[key]`, which forces dereferencing of '->'
+    # in ParameterSets which support it.
+    items = [(key, d[key]) for key in d.keys()]
+    items.sort(key=lambda item: item[0] + '.' if isinstance(item[1], dict)
+                                else item[0])
+    for key, value in items:
+        if isinstance(value, dict):
+            yield from _sorted_nested_items(value, prefix + key + '.')
+        else:
+            yield prefix + key, value
+
+def _hash_params(h, params):
+    # Feed sorted parameters to the hash object `h`, skipping keys starting with '_'
+    for key, value in _sorted_flat_items(params):
+        _hash_update(h, key, _digest_value(value))
+
+def _append_suffix(basename, suffix):
+    # `basename` should end with '_', unless suffix is empty
     if isinstance(suffix, str):
         suffix = suffix.lstrip('_')
     if suffix is None or suffix == "":
@@ -450,7 +806,65 @@ def digest(params, suffix=None, convert_to_arrays=True):
         return basename + '_'.join([str(s) for s in suffix])
     else:
         return basename + str(suffix)
-get_filename = digest
+
+def digest_hasher(base_params, convert_to_arrays=True):
+    """
+    Return a hash object which has already consumed `base_params`.
+    Use with `digest_from_hasher` to compute names for many parameter sets
+    which extend the same base parameters; the base parameters are then
+    hashed only once.
+
+    ..Note:
+    Names obtained this way depend on how parameters are split between
+    base and variant, and therefore differ from those returned by `digest`.
+    """
+    h = _sha1()
+    params = _normalize_for_digest(base_params, convert_to_arrays)
+    if params is not None:
+        _hash_params(h, params)
+    return h
+
+def digest_from_hasher(hasher, params, suffix=None, convert_to_arrays=True):
+    """
+    Compute a name for `params`, starting from a hash object returned by
+    `digest_hasher`. `hasher` is not modified, so it can be reused.
+
+    Parameters
+    ----------
+    hasher: hash object
+        As returned by `digest_hasher`.
+    params: ParameterSet
+        The parameters which are not part of the base parameters.
+    suffix, convert_to_arrays:
+        See `digest`.
+    """
+    h = hasher.copy()
+    params = _normalize_for_digest(params, convert_to_arrays)
+    if params is not None:
+        _hash_params(h, params)
+    return _append_suffix(h.hexdigest() + '_', suffix)
+
+def digests(params_list, suffixes=None, convert_to_arrays=True, legacy=True):
+    """
+    Equivalent to `[digest(p, s) for p, s in zip(params_list, suffixes)]`,
+    but sets NumPy's print options only once for the whole list. Use this
+    when computing many filenames.
+
+    Parameters
+    ----------
+    params_list: iterable of ParameterSets
+    suffixes: iterable of str, or None
+        If given, must have the same length as `params_list`.
+    convert_to_arrays, legacy: bool
+        Passed on to `digest`.
+    """
+    params_list = list(params_list)
+    if suffixes is None:
+        suffixes = [None] * len(params_list)
+    with np.printoptions(**_get_filename_printoptions()):
+        return [digest(p, s, convert_to_arrays, legacy)
+                for p, s in zip(params_list, suffixes)]
+get_filenames = digests
 
 def params_to_arrays(params):
     """
@@ -462,15 +876,35 @@ def params_to_arrays(params):
     ParamType = type(params)
         # Allows to work with types derived from ParameterSet, for example Sumatra's
         # NTParameterSet
-    for name, val in params.items():
-        if isinstance(val, (ParameterSetBase, dict)):
-            params[name] = params_to_arrays(val)
-        elif (not isinstance(val, str)
-            and isinstance(val, Iterable)
-            and all(isinstance(v, Number) for v in flatten(val))):
-                # The last condition leaves objects like ('lin', 0, 1) as-is;
+    # Walk the tree with an explicit stack rather than recursion, converting
+    # leaves in place. Nested parameter sets are recorded in `subsets`, in
+    # the order they are visited.
+    subsets = []
+    stack = [params]
+    while stack:
+        cur = stack.pop()
+        for name, val in cur.items():
+            if isinstance(val, (ParameterSetBase, dict)):
+                stack.append(val)
+                subsets.append((cur, name, val))
+            elif isinstance(val, np.ndarray):
+                # Already normalized (e.g. by a previous call, since conversion
+                # is done in place): don't walk and copy the array again
+                continue
+            elif _is_iterable(val) and not isinstance(val, str):
+                # Let NumPy infer the dtype, and only keep the result if it is
+                # numeric. This leaves objects like ('lin', 0, 1) as-is;
                 # otherwise they would be casted to a single type
-            params[name] = np.array(val)
+                try:
+                    arr = np.asarray(val)
+                except (ValueError, TypeError):
+                    # E.g. ragged nested lists
+                    continue
+                if arr.dtype.kind in 'biufc':
+                    cur[name] = arr
+    # Rewrap nested parameter sets, children before their parents
+    for parent, name, val in reversed(subsets):
+        parent[name] = type(val)(val)
     return ParamType(params)
 
 def params_to_lists(params):
@@ -520,38 +954,19 @@ def prune(params, keep, exclude=None):
         Copy of `params`, keeping only the attributes given in `keep`.
     """
     # Normalize filters
-    if isinstance(keep, str) or not isinstance(keep, Iterable):
+    if isinstance(keep, str) or not _is_iterable(keep):
         keepfilters = [keep]
     else:
         keepfilters = keep
     if exclude is None:
         excludefilters = []
-    elif isinstance(exclude, str) or not isinstance(exclude, Iterable):
+    elif isinstance(exclude, str) or not _is_iterable(exclude):
         excludefilters = [exclude]
     else:
         excludefilters = exclude
 
     # Create a new ParameterSet, and fill it with the elements of `params`
-    newparams = ParameterSet({})
-    for filter in keepfilters:
-        if '.' in filter:
-            filter, subfilter = filter.split('.', maxsplit=1)
-        else:
-            subfilter = None
-        if filter not in params:
-            logger.debug("Tried to filter a ParameterSet with '{}', but it "
-                         "contains no such key. Filter was ignored.")
-        else:
-            if subfilter is None:
-                if filter in newparams:
-                    # This parameter name was already added – almost certainly an error
-                    raise ValueError("Filter parameter '{}' overlaps with another"
-                                     .format(filter))
-                newparams[filter] = params[filter].copy()  # Don't touch the original data
-            else:
-                if filter not in newparams:
-                    newparams[filter] = ParameterSet({})
-                newparams[filter][subfilter] = prune(params[filter], subfilter)[subfilter]
+    newparams = _prune_keep(params, keepfilters)
 
     # Remove the excluded parameters
     for filter in excludefilters:
@@ -564,6 +979,47 @@ def prune(params, keep, exclude=None):
 
     return newparams
 
+def _prune_keep(params, keepfilters, toplevel=True):
+    """
+    Implementation of the `keep` filters of `prune`.
+    Filters are grouped by their first key, so that each nested parameter set
+    is only pruned once, with all the filters which apply to it.
+    A filter which keeps a whole parameter takes precedence over filters for
+    its contents. At the top level, keeping a parameter which was already
+    kept by another filter raises ValueError; in nested parameter sets,
+    duplicate filters are ignored. Nested parameter sets in which no filter
+    matched are omitted.
+    """
+    kept = OrderedDict()
+        # For each kept key, None to keep the whole parameter, or a list of
+        # the remaining parts of nested filters
+    for filter in keepfilters:
+        filter, _, subfilter = filter.partition('.')
+        if filter not in params:
+            logger.debug("Tried to filter a ParameterSet with '{}', but it "
+                         "contains no such key. Filter was ignored."
+                         .format(filter))
+        elif subfilter == '':
+            if toplevel and filter in kept:
+                # This parameter name was already added – almost certainly an error
+                raise ValueError("Filter parameter '{}' overlaps with another"
+                                 .format(filter))
+            kept[filter] = None
+        elif filter not in kept:
+            kept[filter] = [subfilter]
+        elif kept[filter] is not None:
+            kept[filter].append(subfilter)
+        # else: The whole parameter was already kept
+    newparams = ParameterSet({})
+    for filter, subfilters in kept.items():
+        if subfilters is None:
+            newparams[filter] = params[filter].copy()  # Don't touch the original data
+        else:
+            subparams = _prune_keep(params[filter], subfilters, toplevel=False)
+            if len(subparams) > 0:
+                newparams[filter] = subparams
+    return newparams
+
 ###########################
 # Comparing ParameterSets
 ###########################
@@ -607,6 +1063,7 @@ def dfdiff(pset1, pset2, name1='pset 1', name2='pset 2'):
 
 def psets_to_dataframe(*args, **psets):
     from itertools import count, chain
+    import pandas as pd  # Only imported when needed; pandas is slow to import
 
     # Add unlabelled parameter sets to psets with default names
     if len(args) > 0:
@@ -618,19 +1075,36 @@ def psets_to_dataframe(*args, **psets):
                              "clashes.")
         psets.update(newpsets)
 
-    d = {lbl: {tuple(k.split('.')) : v for k, v in ParameterSet(pi).flatten().items()}
-     for lbl, pi in psets.items()}
+    d = {lbl: dict(_flat_tuple_items(pi if isinstance(pi, dict)
+                                     else ParameterSet(pi)))
+         for lbl, pi in psets.items()}
     # Make sure all keys have same length, otherwise we get all NaNs (ind -> 'inner dict')
     indlens = (len(ik) for ik in
                chain.from_iterable(ind.keys() for ind in d.values()))
     klen = max(chain([0], indlens))
     if klen == 0:
-        d = {}
-    else:
-        d = {ok: {k + ('–',)*(klen-len(k)): v for k, v in od.items()}
-             for ok, od in d.items()}
+        return pd.DataFrame({})
+    d = {ok: {k + ('–',)*(klen-len(k)): v for k, v in od.items()}
+         for ok, od in d.items()}
 
-    return pd.DataFrame(d)
+    # Align the parameter sets ourselves, rather than letting pandas align
+    # a dict of dicts. Keys are kept in the order they are first seen.
+    keys = list(dict.fromkeys(chain.from_iterable(d.values())))
+    columns = {lbl: [od.get(k, np.nan) for k in keys] for lbl, od in d.items()}
+    return pd.DataFrame(columns, index=pd.MultiIndex.from_tuples(keys))
+
+def _flat_tuple_items(d, prefix=()):
+    """
+    Iterate over the `(key, value)` pairs of the flattened nested dictionary
+    `d`, with keys given as tuples. Equivalent to
+    `((tuple(k.split('.')), v) for k, v in ParameterSet(d).flatten().items())`,
+    without copying `d` or joining and splitting keys.
+    """
+    for key, value in d.items():
+        if isinstance(value, dict):
+            yield from _flat_tuple_items(value, prefix + (key,))
+        else:
+            yield prefix + (key,), value
 
 ParamRec = namedtuple('ParamRec', ['label', 'parameters'])
     # Data structure for associating a name to a parameter set
@@ -684,6 +1158,7 @@ class ParameterComparison:
         Changes the value of pandas.options.display.max_columns
         (to ensure all parameter keys are shown)
         """
+        import pandas as pd
         colnames = self._get_colnames(depth)
         columns = [ [self._display_param(rec, name) for name in colnames]
                     for rec in self.records ]
@@ -726,96 +1201,145 @@ def _isndarray(a):
     """
     # A selection of attributes sufficiently specific
     # for us to treat `a` as a Numpy array.
-    array_attrs = {'all', 'any'}
-    return array_attrs.issubset(dir(a))
+    # (Test with `hasattr` rather than `dir`, which lists all attributes.)
+    return hasattr(a, 'all') and hasattr(a, 'any')
+
+_missing = object()
+    # Sentinel used by `_dict_diff` for missing elements
+_sequence_types = (list, tuple)
+
+def _numeric_sequences_equal(a, b):
+    """
+    Compare two (possibly nested) sequences of numbers as arrays.
+    Return None if they aren't both rectangular and numeric.
+    """
+    try:
+        a, b = np.asarray(a), np.asarray(b)
+    except ValueError:
+        # Ragged nested sequences
+        return None
+    if a.dtype.kind not in 'biufc' or b.dtype.kind not in 'biufc':
+        return None
+    return a.shape == b.shape and bool((a == b).all())
 
 def _dict_diff(a, b):
     """
     Ported from sumatra.parameters to allow comparing arrays and lists.
     """
-    a_keys = set(a.keys())
-    b_keys = set(b.keys())
-    intersection = a_keys.intersection(b_keys)
-    difference1 = a_keys.difference(b_keys)
-    difference2 = b_keys.difference(a_keys)
+    if a is b:
+        # Shortcut: same object (e.g. a subtree shared between records)
+        return {}, {}
+    # Key views support set operations, so there is no need to copy them
+    a_keys = a.keys()
+    b_keys = b.keys()
+    intersection = a_keys & b_keys
+    difference1 = a_keys - b_keys
+    difference2 = b_keys - a_keys
     result1 = dict([(key, a[key]) for key in difference1])
     result2 = dict([(key, b[key]) for key in difference2])
     # Now need to check values for intersection....
     for item in intersection:
-        if isinstance(a[item], dict):
-            if not isinstance(b[item], dict):
-                result1[item] = a[item]
-                result2[item] = b[item]
+        aval, bval = a[item], b[item]
+        if aval is bval:
+            # Same object: no need to compare contents
+            continue
+        if isinstance(aval, dict):
+            if not isinstance(bval, dict):
+                result1[item] = aval
+                result2[item] = bval
             else:
-                d1, d2 = _dict_diff(a[item], b[item])
+                d1, d2 = _dict_diff(aval, bval)
                 if d1:
                     result1[item] = d1
                 if d2:
                     result2[item] = d2
         else:
-            if _isndarray(a[item]) or _isndarray(b[item]):
-                equal = (a[item] == b[item]).all()
-            elif isinstance(a[item], Iterable):
-                equal = ( isinstance(b[item], Iterable)
-                          and all(x == y for x, y in zip(a[item], b[item]))
-                          and len(list(a[item])) == len(list(b[item])) )
-                    # len() == len() tests for different length generators
+            if (type(aval) in _sequence_types
+                and type(bval) in _sequence_types):
+                # Numeric sequences are compared with NumPy
+                equal = _numeric_sequences_equal(aval, bval)
             else:
-                equal = (a[item] == b[item])
+                equal = None
+            if equal is not None:
+                pass
+            elif _isndarray(aval) or _isndarray(bval):
+                equal = (aval == bval).all()
+            elif _is_iterable(aval):
+                # Iterables of different lengths are padded with `_missing`,
+                # which compares unequal to everything; this also works
+                # for generators, which can only be iterated once
+                equal = ( _is_iterable(bval)
+                          and all(x is not _missing and y is not _missing
+                                  and x == y
+                                  for x, y in itertools.zip_longest(
+                                      aval, bval, fillvalue=_missing)) )
+            else:
+                equal = (aval == bval)
             if not equal:
-                result1[item] = a[item]
-                result2[item] = b[item]
+                result1[item] = aval
+                result2[item] = bval
     if len(result1) + len(result2) == 0:
         assert a == b, "Error in _dict_diff()"
     return result1, result2
 
-def _param_diff(params1, params2, name1="", name2=""):
-    KeyDiff = namedtuple('KeyDiff', ['name1', 'name2', 'keys'])
-    NestingDiff = namedtuple('NestingDiff', ['key', 'name'])
-    TypeDiff = namedtuple('TypeDiff', ['key', 'name1', 'name2'])
-    ValueDiff = namedtuple('ValueDiff', ['key', 'name1', 'name2'])
-
-    diff_types = {'keys': KeyDiff,
-                  'nesting': NestingDiff,
-                  'type': TypeDiff,
-                  'value': ValueDiff}
-    diffs = {key: set() for key in diff_types.keys()}
-    keys1, keys2 = set(params1.keys()), set(params2.keys())
-    if keys1 != keys2:
-        diffs['keys'].add( KeyDiff(name1, name2, frozenset(keys1.symmetric_difference(keys2))) )
-    def diff_vals(val1, val2):
-        if isinstance(val1, np.ndarray) or isinstance(val2, np.ndarray):
-            return (val1 != val2).any()
+KeyDiff = namedtuple('KeyDiff', ['name1', 'name2', 'keys'])
+NestingDiff = namedtuple('NestingDiff', ['key', 'name'])
+TypeDiff = namedtuple('TypeDiff', ['key', 'name1', 'name2'])
+ValueDiff = namedtuple('ValueDiff', ['key', 'name1', 'name2'])
+
+def _diff_arrays(val1, val2):
+    # Arrays of different shapes differ, even if they can be broadcast
+    if np.shape(val1) != np.shape(val2):
+        return True
+    return (val1 != val2).any()
+
+_diff_vals_table = {np.ndarray: _diff_arrays}
+    # Comparison functions for types where `!=` doesn't return a bool
+
+def _diff_vals(val1, val2):
+    diff = _diff_vals_table.get(type(val1)) or _diff_vals_table.get(type(val2))
+    if diff is None:
+        if (builtins.isinstance(val1, np.ndarray)
+            or builtins.isinstance(val2, np.ndarray)):
+            # Array subclass
+            diff = _diff_arrays
         else:
             return val1 != val2
-    for key in keys1.intersection(keys2):
-        if isinstance(params1[key], ParameterSetBase):
-            if not isinstance(params2[key], ParameterSetBase):
-                diffs['nesting'].add((key, name1))
-            else:
-                for diffkey, diffval in _param_diff(params1[key], params2[key],
-                                                    name1 + "." + key, name2 + "." + key).items():
-                    # Prepend key to all nested values
-                    if hasattr(diff_types[diffkey], 'key'):
-                        diffval = {val._replace(key = key+"."+val.key) for val in diffval}
-                    if hasattr(diff_types[diffkey], 'keys') and len(diffval) > 0:
-                        iter_type = type(next(iter(diffval)).keys)  # Assumes all key iterables have same type
-                        diffval = {val._replace(keys = iter_type(key+"."+valkey for valkey in val.keys))
-                                   for val in diffval}
-                    # Update differences dictionary with the nested differences
-                    diffs[diffkey].update(diffval)
-        elif isinstance(params2[key], ParameterSetBase):
-            diffs['nesting'].add(NestingDiff(key, name2))
-        elif type(params1[key]) != type(params2[key]):
-            diffs['type'].add(TypeDiff(key, name1, name2))
-        elif diff_vals(params1[key], params2[key]):
-            diffs['value'].add(ValueDiff(key, name1, name2))
+    return diff(val1, val2)
+
+def _param_diff(params1, params2, name1="", name2=""):
+    diffs = {'keys': set(), 'nesting': set(), 'type': set(), 'value': set()}
+    # Nested parameter sets are compared by pushing them on a stack, along
+    # with the prefix to prepend to their keys.
+    stack = [(params1, params2, name1, name2, "")]
+    while len(stack) > 0:
+        p1, p2, n1, n2, prefix = stack.pop()
+        if p1 is p2:
+            # Shortcut: same object (e.g. a subtree shared between records)
+            continue
+        keys1, keys2 = p1.keys(), p2.keys()
+        if keys1 != keys2:
+            diffs['keys'].add(
+                KeyDiff(n1, n2, frozenset(prefix + key for key in
+                                          keys1 ^ keys2)))
+        for key in keys1 & keys2:
+            val1, val2 = p1[key], p2[key]
+            if isinstance(val1, ParameterSetBase):
+                if not isinstance(val2, ParameterSetBase):
+                    diffs['nesting'].add(NestingDiff(prefix + key, n1))
+                else:
+                    stack.append((val1, val2, n1 + "." + key, n2 + "." + key,
+                                  prefix + key + "."))
+            elif isinstance(val2, ParameterSetBase):
+                diffs['nesting'].add(NestingDiff(prefix + key, n2))
+            elif type(val1) != type(val2):
+                diffs['type'].add(TypeDiff(prefix + key, n1, n2))
+            elif _diff_vals(val1, val2):
+                diffs['value'].add(ValueDiff(prefix + key, n1, n2))
 
     return diffs
 
 def param_diff(params1, params2, name1="", name2=""):
-    print("Bug warning: current implementation does not catch some differences "
-          "in shape because of broadcasting (e.g. [[1 2], [1, 2]] vs [1, 2]).")
     if name1 == "":
         name1 = "params1" if name2 != "params1" else "params1_1"
     if name2 == "":
@@ -851,30 +1375,73 @@ def get_differing_keys(records):
     assert(isinstance(records, Iterable))
     assert(all(isinstance(rec, ParamRec) for rec in records))
 
-    diffpairs = {(i,j) : _param_diff(records[i].parameters, records[j].parameters,
-                                     records[i].label, records[j].label)
-                  for i, j in itertools.combinations(range(len(records)), 2)}
-    def get_keys(diff):
-        assert(bool(hasattr(diff, 'key')) != bool(hasattr(diff, 'keys'))) # xor
-        if hasattr(diff, 'key'):
-            return set([diff.key])
-        elif hasattr(diff, 'keys'):
-            return set(diff.keys)
-    differing_keys = set().union( *[ get_keys(diff)
-                                     for diffpair in diffpairs.values() # all difference types between two pairs
-                                     for difftype in diffpair.values()  # keys, nesting, type, value
-                                     for diff in difftype ] )
+    # Rather than diffing every pair of records, flatten each parameter set
+    # once and compare the records key by key. A key differs if, for some
+    # pair of records, `_param_diff` would report it.
+    flat_params = [_flat_param_nodes(rec.parameters) for rec in records]
+    differing_keys = set()
+    for path in dict.fromkeys(itertools.chain.from_iterable(flat_params)):
+        values = [fp[path] for fp in flat_params if path in fp]
+        # Key missing from some of the records where its parent is a set
+        if len(path) == 1:
+            nparents = len(flat_params)
+        else:
+            nparents = sum(1 for fp in flat_params
+                           if isinstance(fp.get(path[:-1]), ParameterSetBase))
+        if len(values) < nparents:
+            differing_keys.add('.'.join(path))
+            continue
+        # Key which is a set only in some of the records
+        nsets = sum(1 for val in values if isinstance(val, ParameterSetBase))
+        if nsets > 0:
+            if nsets < len(values):
+                differing_keys.add('.'.join(path))
+            continue
+        # Key whose type or value differs between records
+        val0 = values[0]
+        type0 = type(val0)
+        if any(type(val) != type0 for val in values[1:]):
+            differing_keys.add('.'.join(path))
+            continue
+        # Records often share values (e.g. when they were created from the
+        # same parameter set), so only compare each distinct object once
+        compared = {}
+        for val in values[1:]:
+            if id(val) not in compared:
+                compared[id(val)] = _diff_vals(val0, val)
+                if compared[id(val)]:
+                    differing_keys.add('.'.join(path))
+                    break
 
     return differing_keys
 
+def _flat_param_nodes(params):
+    """
+    Return a dictionary of all the values in a nested parameter set, keyed by
+    their path as a tuple. Unlike flattening, nested parameter sets are
+    included as well.
+    """
+    nodes = {}
+    stack = [(params, ())]
+    while len(stack) > 0:
+        d, prefix = stack.pop()
+        for key in d.keys():
+            val = d[key]
+            path = prefix + (key,)
+            nodes[path] = val
+            if isinstance(val, ParameterSetBase):
+                stack.append((val, path))
+    return nodes
+
 def structure_keys(keys):
     #keys = sorted(keys)
-    roots = set([key.split('.')[0] for key in keys])
-    tree = {root: [] for root in roots}
-    for root in roots:
-        for key in keys:
-            if '.' in key and key.startswith(root):
-                tree[root].append('.'.join(key.split(".")[1:]))
+    # Group the keys by their root in a single pass
+    tree = {}
+    for key in keys:
+        root, sep, subkey = key.partition('.')
+        subkeys = tree.setdefault(root, [])
+        if sep:
+            subkeys.append(subkey)
 
     return ParameterSet({root: None if subkeys == [] else structure_keys(subkeys)
                          for root, subkeys in tree.items()})
@@ -883,8 +1450,6 @@ def structure_keys(keys):
 # Parameter file expansion
 ###########################
 
-ExpandResult = namedtuple("ExpandResult", ['strs', 'done'])
-
 def expand_params(param_str, fail_on_unexpanded=False, parser=None):
     """
     Expand a parameter description into multiple descriptions.
@@ -923,13 +1488,27 @@ def expand_params(param_str, fail_on_unexpanded=False, parser=None):
         # TODO: Expanding urls as we expand blocks, rather than all
         #       at once at the beginning, would allow to apply expansion
         #       to parameter sets.
-    param_strs = [strip_comments(param_str)]
-    done = False
-    while not done:
-        res_lst = [_expand(s, fail_on_unexpanded, parser) for s in param_strs]
-        assert(isinstance(res.strs, list) for res in res_lst)
-        param_strs = [s for res in res_lst for s in res.strs]
-        done = all(res.done for res in res_lst)
+    # Depth-first expansion: each string is expanded at its first expansion
+    # site, and the resulting strings pushed back on the stack. Everything
+    # before that site is already expanded, so the search for the next site
+    # resumes from there.
+    # Blocks of an expanded string are obtained by shifting those of the
+    # string it was derived from, rather than parsing it again.
+    param_strs = []
+    stack = [(strip_comments(param_str), 0, None)]
+    while len(stack) > 0:
+        s, start, get_blocks = stack.pop()
+        site = _expand(s, fail_on_unexpanded, parser, start, get_blocks)
+        if site is None:
+            param_strs.append(s)
+        else:
+            i, block, blocks = site
+            # Push in reverse order, so that strings are popped in element order
+            stack.extend(
+                (s[:i] + el + s[block.stop:], i,
+                 functools.partial(_shift_blocks, blocks, i, block, el_start, el)
+                 if isinstance(block, Block) else None)
+                for el_start, el in reversed(block.elements))
 
     return param_strs
 
@@ -989,45 +1568,111 @@ def expand_urls(s):
     This also means that no validation is performed (e.g. urls in keys will
     be blindly expanded rather throw an error).
     """
-    start = 0
-    while True:
-        # Remove comments at every iteration, since every time we expand a
-        # url it may contain comments. In particular, we want to avoid expanding
-        # commented out urls.
-        s = strip_comments(s)
-        start = s.find('url(', start)
-        if start >= 0:
-            stop = s.find(')', start)
-            if stop is None:
-                raise SyntaxError("`url(` has no matching closing parenthesis.")
-            url = s[start+4:stop].strip("'\"")
-            with open(url) as f:
-                substr = strip_comments(f.read())
-            s = s[:start] + substr + s[stop+1:]
-        else:
-            break
+    # Remove comments, since we want to avoid expanding commented out urls.
+    # The expanded string is assembled from a list of pieces, rather than
+    # rebuilding the whole string for every url.
+    s = strip_comments(s)
+    pieces = []
+    nurls = _url_pieces(s, {}, pieces)
+    if nurls == 0:
+        return s
+    # All pieces are already stripped; this only removes trailing whitespace
+    # at the junctions between pieces
+    s = strip_comments(''.join(pieces))
+    # Stripping removes one trailing empty line each time; make the result
+    # the same as stripping after each url insertion
+    for i in range(nurls - 1):
+        if s.endswith('\n'):
+            s = s[:-1]
     return s
 
-def _expand(s, fail_on_unexpanded, parser):
+def _url_pieces(s, contents, pieces):
+    """
+    Append to `pieces` the parts of `s`, with each url specification replaced
+    by the (recursively expanded) contents of its file. `contents` stores the
+    stripped contents of files already read, keyed by url.
+    Return the number of urls which were expanded.
+    """
+    nurls = 0
+    pos = 0
+    while True:
+        start = s.find('url(', pos)
+        if start < 0:
+            break
+        stop = s.find(')', start)
+        if stop == -1:
+            raise SyntaxError("`url(` has no matching closing parenthesis.")
+        url = s[start+4:stop].strip("'\"")
+        if url not in contents:
+            with open(url) as f:
+                contents[url] = strip_comments(f.read())
+        pieces.append(s[pos:start])
+        nurls += 1 + _url_pieces(contents[url], contents, pieces)
+        pos = stop + 1
+    pieces.append(s[pos:])
+    return nurls
+
+def _expand(s, fail_on_unexpanded, parser, start=0, get_blocks=None):
+    """
+    Return the first expansion site in `s` at or after position `start`,
+    as a tuple `(i, block, blocks)`, where `i` is the position of the
+    expansion character, `block` the expanded block and `blocks` all the
+    blocks in `s`. Return `None` if there is nothing left to expand.
+    If given, `get_blocks()` must return the blocks in `s` starting after
+    `start`; otherwise they are obtained with `parser.extract_blocks(s)`.
+    """
     # TODO: Allow multicharacter expansion tokens. Then we can use
     # this to exand `url()`
-    blocks = parser.extract_blocks(s)
-    for i, c in enumerate(s):
-        if c in parser.expanders:
-            if i+1 in blocks:
-                block = blocks[i+1]
-                expanded_str = [s[:i] + str(el) + s[block.stop:]
-                                for el in block.elements.values()]
-                # Return list of expanded strings and continuation flag
-                return ExpandResult(expanded_str, False)
-            elif fail_on_unexpanded:
-                raise ValueError("Expansion identifier '*' at position {} "
-                                 "must be followed by a bracketed expression.\n"
-                                 "Context: '{}'."
-                                 .format(i, s[max(i-10,0):i+10]))
-    # Found nothing to expand; return the given string and termination flag
-    # Wrap the string in a list to match the expected format
-    return ExpandResult([s], True)
+    blocks = None  # Only parse the string if it contains an expander
+    expanders = parser.expanders
+    while True:
+        # Jump to the next expansion character with `str.find`, rather than
+        # testing each character
+        positions = [i for i in (s.find(c, start) for c in expanders)
+                     if i != -1]
+        if len(positions) == 0:
+            # Found nothing to expand
+            return None
+        i = min(positions)
+        if blocks is None:
+            blocks = (parser.extract_blocks(s) if get_blocks is None
+                      else get_blocks())
+        if i+1 in blocks:
+            return i, blocks[i+1], blocks
+        elif fail_on_unexpanded:
+            raise ValueError("Expansion identifier '*' at position {} "
+                             "must be followed by a bracketed expression.\n"
+                             "Context: '{}'."
+                             .format(i, s[max(i-10,0):i+10]))
+        start = i+1
+
+def _shift_blocks(blocks, i, block, el_start, el):
+    """
+    Given the blocks of a string `s`, return those of
+    `s[:i] + el + s[block.stop:]`, where `el` is the element of `block`
+    starting at `el_start`. Only blocks starting after `i` are returned,
+    since those before have already been expanded.
+    """
+    el_stop = el_start + len(el)
+    delta = len(el) - (block.stop - i)
+    new_blocks = {}
+    copies = {}  # Maps original blocks to their shifted copies
+    for start, b in blocks.items():
+        if el_start <= start and b.stop <= el_stop:
+            # Block within the inserted element
+            offset = i - el_start
+        elif start >= block.stop:
+            # Block after the expanded block
+            offset = delta
+        else:
+            continue
+        new_b = b.shifted(offset)
+        new_blocks[start + offset] = new_b
+        copies[id(b)] = new_b
+    # Nested blocks are always kept with their parent
+    for new_b in new_blocks.values():
+        new_b.blocks = [copies[id(b)] for b in new_b.blocks]
+    return new_blocks
 
 class Parser():
     """Basic parser for nested structures with opening and closing brackets."""
@@ -1050,41 +1695,62 @@ class Parser():
         if idx != -1:
             return self.open_brackets[idx]
 
+    def _get_dispatch_table(self):
+        """
+        Return a dictionary mapping each special character to its role:
+        ('open', closer), ('close', opener) or ('sep', None).
+        The table is rebuilt on each call to `extract_blocks`, so that
+        changes to the bracket attributes are always taken into account.
+        """
+        # Fill in reverse order of precedence, so that e.g. a character
+        # listed both as a bracket and a separator is treated as a bracket
+        table = {c: ('sep', None) for c in self.separators}
+        table.update((c, ('close', self.get_opener(c)))
+                     for c in self.close_brackets)
+        table.update((c, ('open', self.get_closer(c)))
+                     for c in self.open_brackets)
+        return table
+
     def extract_blocks(self, s):
         block_stack = deque()  # Unclosed blocks
         blocks = {}       # Closed blocks, keyed by their starting index
-        for i, c in enumerate(s):
-            if c in self.open_brackets:
-                block = Block(start=i, opener=c, closer=self.get_closer(c))
+        table = self._get_dispatch_table()
+        # Let the regex engine find the special characters, rather than
+        # testing each character of `s` in Python
+        special = ''.join(re.escape(c) for c in table if len(c) == 1)
+        if special == '':
+            return blocks
+        for m in re.finditer('[' + special + ']', s):
+            i, c = m.start(), m.group()
+            role, match = table[c]
+            if role == 'open':
+                block = Block(start=i, opener=c, closer=match)
                 if len(block_stack) > 0:
                     block_stack[-1].blocks.append(block)
                 block_stack.append(block)
-            elif c in self.close_brackets:
-                block = block_stack[-1]
+            elif role == 'close':
                 if len(block_stack) == 0:
                     raise ValueError("Unmatched closing bracket '{}' at position {}."
                                      .format(c, i))
-                if c != block_stack[-1].closer:
+                block = block_stack[-1]
+                if c != block.closer:
                     raise ValueError("Closing bracket '{}' at position {} does not "
                                      "match opening bracket '{}' at position {}."
                                      .format(c, i, block.opener,
                                              block.start))
                 block.stop = i+1
 
-                # TODO: make this method of the Elements object or something
-                el_start_i = list(block.elements.keys())[-1]
-                el_stop_i = i
-                block.elements[el_start_i] = s[el_start_i:el_stop_i]
+                el_start_i = block.current_el_start
+                block.elements.append((el_start_i, s[el_start_i:i]))
 
                 blocks[block.start] = block_stack.pop()
-            elif c in self.separators:
+            else:  # separator
                 block = block_stack[-1]
 
-                el_start_i = list(block.elements.keys())[-1]
-                el_stop_i = i
-                block.elements[el_start_i] = s[el_start_i:el_stop_i]
+                el_start_i = block.current_el_start
+                block.elements.append((el_start_i, s[el_start_i:i]))
 
-                block.elements[el_stop_i+1] = None
+                block.current_el_start = i+1
 
         if len(block_stack) > 0:
             raise ValueError("Unmatched opening bracket '{}' at position {}."
@@ -1093,9 +1759,6 @@ class Parser():
 
         return blocks
 
-            # A dictionary of the elements separated by one of the 'separators'
-            # The key is the index of the first character
-
 class Block(SimpleNamespace):
     def __init__(self, start, opener, closer):
         super().__init__()
@@ -1103,9 +1766,27 @@ class Block(SimpleNamespace):
         self.stop = None
         self.opener = opener
         self.closer = closer
-        self.elements = OrderedDict([(start+1, None)])
+        self.elements = []
+            # A list of the elements separated by one of the 'separators'
+            # Each element is stored as a tuple (start index, string)
+        self.current_el_start = start+1
+            # Index of the first character of the element being parsed
         self.blocks = []
 
+    def shifted(self, offset):
+        """
+        Return a copy of this block, with all positions shifted by `offset`.
+        The returned block's `blocks` list still references the original
+        nested blocks.
+        """
+        block = Block(self.start + offset, self.opener, self.closer)
+        block.stop = self.stop + offset
+        block.elements = [(el_start + offset, el)
+                          for el_start, el in self.elements]
+        block.current_el_start = self.current_el_start + offset
+        block.blocks = list(self.blocks)
+        return block
+
 
 ###################
 # ParameterSet sampler
@@ -1119,7 +1800,7 @@ class ParameterSetSampler:
     """
     This class mainly serves two purposes:
       - Convert a distribution definition into a sampler for that parameter
-      - Maintain a cache of the state of the RNG, so that draws
+      - Maintain its own random number generator, so that draws
         a) are consistent across runs and code changes
            (only changes to the parameter file itself will change the chosen parameters)
         b) do not affect random draws from outside this module
@@ -1187,22 +1868,30 @@ class ParameterSetSampler:
         will be for the *transformed* variable.
     seed: int
         If given, overrides any seed present in `dists`.
+    batch_size: int
+        (Optional) Number of samples drawn at once for each variable.
+        Values larger than 1 reduce overhead when many samples are drawn,
+        but change which values are drawn for a given seed. (Draws are
+        still reproducible for a given seed and batch size.)
+        Default is 1.
 
     TODO: Cast parameters with subpopulations as BroadcastableBlockArray ?
     """
     population_attrs = ['population', 'populations', 'mixture', 'mixtures', 'label', 'labels']
-    def __init__(self, dists, seed=None):
+    def __init__(self, dists, seed=None, batch_size=1):
         """
         """
         # Implementation:
         # In order to always sample the same way, we set an order for parameters.
-        # We can then sample them sequentially (i.e. each is sampled once, before
-        # any one is sampled twice).
-        # At any time, we can save the state of the RNG and reload it later to continue sampling.
+        # We can then sample them in rounds (i.e. each is sampled once, before
+        # any one is sampled twice); see `_sample_round`.
+        # Draws use an RNG private to this sampler, so the global NumPy RNG
+        # is never touched.
 
         dists = ParameterSet(dists)  # Normalize the input (allows e.g. urls)
+        self._dists = dists          # Kept to create new samplers with `spawn`
+        self._batch_size = batch_size
         self._iter_idx = None        # Internal index for the iterator
-        orig_state = np.random.get_state()   # Store the current RNG state so it can be reset later
 
         # Get population / mixture labels
         #popstrs = [ attr for attr in [getattr(dists, attr, None) for attr in self.population_strs]
@@ -1216,11 +1905,15 @@ class ParameterSetSampler:
         else:
             popnames = None
 
-        # Set seed
+        # Create the RNG
+        # We use a RandomState rather than a Generator, because its
+        # distribution algorithms are those of the global RNG used by earlier
+        # versions; this keeps draws for a given seed unchanged.
         if seed is None:
             seed = getattr(dists, 'seed', None)
-        if seed is not None:
-            np.random.seed(seed)
+        self._seed = seed
+        self._rng = np.random.RandomState()
+        self._seed_rng(seed)
 
         # Get all the variable names and fix their order.
         # If we didn't fix their order here, changing the order in the parameter file
@@ -1229,22 +1922,20 @@ class ParameterSetSampler:
 
         # Create the samplers
         self._samplers = {
-            varname: ParameterSampler(varname, dists[varname], popnames)
+            varname: ParameterSampler(varname, dists[varname], popnames,
+                                      batch_size, self._rng)
             for varname in self.varnames }
-
-        self._samplers[self.varnames[0]].set_previous(
-            self._samplers[self.varnames[-1]], -1)
-        for i in range(1, len(self.varnames)):
-            self._samplers[self.varnames[i]].set_previous(
-                self._samplers[self.varnames[i-1]], 0)
-
-        # Reset the RNG to its external state
-        self.rng_state = np.random.get_state()
-        np.random.set_state(orig_state)
-
-    # At the moment we shouldn't access samplers directly, because they don't
-    # set the RNG state. Eventually we should change this, and then providing
-    # this iterator might become a good idea
+        # Samplers in the order of `self.varnames`, and the subset of those
+        # which actually sample (as opposed to returning a fixed value),
+        # so that sampling rounds don't need to look them up by name
+        self._samplers_list = tuple(self._samplers[varname]
+                                    for varname in self.varnames)
+        self._sampling_samplers = tuple(sampler for sampler in self._samplers_list
+                                        if sampler.sampled_idx is not None)
+
+    # At the moment we shouldn't access samplers directly, because this would
+    # bypass the sampling order. Eventually we should change this, and then
+    # providing this iterator might become a good idea
     # #######
     # # Define iterator
     # def __iter__(self):
@@ -1261,11 +1952,70 @@ class ParameterSetSampler:
     # # End iterator definition
     # #######
 
+    def _seed_rng(self, seed):
+        if seed is not None:
+            self._rng.seed(seed)
+        else:
+            # Without a seed, continue from the current state of the global RNG
+            self._rng.set_state(np.random.get_state())
+
+    def reset(self, seed=None):
+        """
+        Return the sampler to the state it had after construction, so that
+        it can be reused instead of constructing a new one.
+
+        Parameters
+        ----------
+        seed: int
+            (Optional) New seed for the sampler. By default, the seed given
+            at construction is used again; if there was none, the RNG
+            continues from the current state of the global RNG.
+        """
+        if seed is not None:
+            self._seed = seed
+        self._seed_rng(self._seed)
+        for sampler in self._samplers_list:
+            sampler._reset()
+
+    def spawn(self, n):
+        """
+        Return `n` new samplers for the same distributions, each with its
+        own RNG. Their seeds are derived from this sampler's seed, so the
+        spawned samplers are reproducible and their draws are independent.
+        They share no mutable state (the `Transform` instances they have in
+        common are stateless), so they can be used in different threads.
+        (Without a seed, the spawned samplers are seeded from fresh entropy.)
+
+        Parameters
+        ----------
+        n: int
+            Number of samplers to create.
+
+        Returns
+        -------
+        list of ParameterSetSampler
+        """
+        seedseq = np.random.SeedSequence(self._seed)
+        return [ParameterSetSampler(self._dists, seed=child.generate_state(4),
+                                    batch_size=self._batch_size)
+                for child in seedseq.spawn(n)]
+
+    @property
+    def rng_state(self):
+        """
+        The current state of the sampler's RNG.
+        Setting it only affects future draws; samples which were already
+        drawn into a batch or sampling round are still returned first.
+        """
+        return self._rng.get_state()
+    @rng_state.setter
+    def rng_state(self, state):
+        self._rng.set_state(state)
+
     @property
     def sampled_varnames(self):
         """Return the names of the variables which we are sampling."""
-        return [name for name, sampler in self._samplers.items()
-                if sampler.sampled_idx is not None]
+        return [sampler.name for sampler in self._sampling_samplers]
 
     def sample(self, varname=None):
         """
@@ -1275,36 +2025,57 @@ class ParameterSetSampler:
         If no variable is specified, the full set is sampled and
         returned as a ParameterSet.
         """
-        orig_state = np.random.get_state()
-        np.random.set_state(self.rng_state)
-
         if varname is None:
-            varname = self.varnames
-
-        if isinstance(varname, str) or not isinstance(varname, Iterable):
-            res = self._samplers[varname]()
+            res = ParameterSet({name: self._draw(sampler) for name, sampler
+                                in zip(self.varnames, self._samplers_list)})
+        elif isinstance(varname, str) or not _is_iterable(varname):
+            res = self._draw(self._samplers[varname])
         else:
-            res = ParameterSet(
-                {name: self._samplers[name]() for name in varname})
-
-        self.rng_state = np.random.get_state()
-        np.random.set_state(orig_state)
+            res = ParameterSet({name: self._draw(self._samplers[name])
+                                for name in varname})
 
         return res
 
+    def _draw(self, sampler):
+        if len(sampler._cache) == 0 and sampler.sampled_idx is not None:
+            self._sample_round()
+        return sampler()
+
+    def _sample_round(self):
+        """
+        Draw one batch for every sampled variable, in the order of
+        `self.varnames`. Since draws are always made in complete rounds, the
+        values obtained for a variable do not depend on the order in which
+        variables are requested.
+        """
+        for sampler in self._sampling_samplers:
+            sampler._sample()
+
+def _batch_item(batch, i):
+    # Indexing arrays with `[i, ...]` returns 0-dim arrays rather than scalars.
+    # Samples are copied, so that they don't keep the whole batch alive.
+    if type(batch) is np.ndarray:
+        return batch[i, ...].copy()
+    else:
+        return batch[i]
+
 class ParameterSampler:
     """
     Implements one of the samplers in ParameterSetSampler.
-    Samplers are set as a circular chain: before computing a new sample,
-    each checks the previous sampler to see if it has been computed up to
-    the same index, plus an offset (offsets should be 0 or negative).
-    This is done to ensure that the same parameter set (if it specifies
-    a seed) always returns the same draws.
+    The ParameterSetSampler is responsible for the order in which samplers
+    draw from the RNG (see `ParameterSetSampler._sample_round`); this is done
+    to ensure that the same parameter set (if it specifies a seed) always
+    returns the same draws.
 
     Sampling happens in the __call__() method.
+    Samples are drawn in batches of `batch_size`; `sampled_idx` counts the
+    number of batches drawn.
     """
     # TODO: See if some code can be shared with pymc3.PyMCPrior.get_dist()
-    def __init__(self, name, desc, popnames=None):
+    def __init__(self, name, desc, popnames=None, batch_size=1, rng=None):
+        if rng is None:
+            rng = np.random  # Use the global RNG
+        get_batch = None
         if not isinstance(desc, ParameterSetBase):
             # It's a fixed value: no need for sampling
             self.sampled_idx = None   # This indicates that we aren't sampling
@@ -1320,13 +2091,15 @@ class ParameterSampler:
             #     # population (in which case no name is necessary)
             #     popnames = ["pop1"]
             self.sampled_idx = 0
-            shapes = [()]
+            axis_sizes = []
+                # Possible sizes along each axis (one per population for
+                # population axes)
             pop_pattern = ()
                 # pop_pattern indicates which dimensions are sampled with
                 # different parameters for each population
             for s in desc.shape:
                 if not isinstance(s, str):
-                    shapes = [ r + (s,) for r in shapes ]
+                    axis_sizes.append((s,))
                     pop_pattern += (False,)
                 else:
                     pop_pattern += (True,)
@@ -1335,11 +2108,10 @@ class ParameterSampler:
                         raise ValueError("The parameter '{}' has a shape with {} "
                                          "components, but we have {} populations."
                                          .format(name, len(pop_sizes), len(popnames)))
-                    shapes = [ r + (int(psize),)
-                               for r in shapes
-                               for psize in pop_sizes ]
+                    axis_sizes.append(tuple(int(psize) for psize in pop_sizes))
+            shapes = list(itertools.product(*axis_sizes))
 
-            pop_samplers = type(self).PopSampler(desc, popnames)
+            pop_samplers = type(self).PopSampler(desc, popnames, rng)
             self._popnames = popnames
             self._pop_samplers = pop_samplers
                 # Used as a hacky handle to recover the sampler params
@@ -1352,150 +2124,209 @@ class ParameterSampler:
             if all(b is False for b in pop_pattern):
                 # There is no population-based sampling
                 assert(len(shapes) == 1)
+                sample_nopops = pop_samplers[NoPops]
                 def get_sample():
                     logger.debug("Getting {} sample.".format(self.name))
-                    return pop_samplers[NoPops](shapes[0])
-            elif pop_pattern == (True,):
-                def get_sample():
-                    logger.debug("Getting {} sample.".format(self.name))
-                    return np.block(
-                        [pop_samplers[key(pop)](shape)
-                         for pop, shape in zip(popnames, shapes)])
-            elif pop_pattern == (False, True):
-                def get_sample():
-                    logger.debug("Getting {} sample.".format(self.name))
-                    return np.block(
-                        [ [ pop_samplers[key(pop)](shape)
-                            for pop, shape in zip(popnames, shapes)] ] )
-            elif pop_pattern == (True, False):
-                def get_sample():
-                    logger.debug("Getting {} sample.".format(self.name))
-                    return np.block(
-                        [ [pop_samplers[key(pop)](shape)]
-                          for pop, shape in zip(popnames, shapes) ] )
-            elif pop_pattern == (True, True):
-                n = len(popnames)
+                    return sample_nopops(shapes[0])
+                if shapes[0] == () and pop_samplers._has_output(NoPops):
+                    # Output functions (e.g. `np.exp`) return scalars rather
+                    # than 0-dim arrays for single draws, so split the batch
+                    # into scalars as well
+                    def get_batch(n):
+                        logger.debug("Getting {} {} samples.".format(n, self.name))
+                        return list(sample_nopops((n,)))
+                else:
+                    def get_batch(n):
+                        # Draw all samples with a single call to the RNG
+                        logger.debug("Getting {} {} samples.".format(n, self.name))
+                        return sample_nopops((n,) + shapes[0])
+            elif pop_pattern in [(True,), (False, True), (True, False),
+                                 (True, True)]:
+                # Precompute where each population block goes in the output,
+                # so that samples can be written directly into a single array.
+                # Blocks are ordered as in `shapes`, which fixes the order
+                # of draws.
+                out_shape = ()
+                plan = [((), (), ())]  # (poplabels, out slices, block shape)
+                for s in desc.shape:
+                    if not isinstance(s, str):
+                        out_shape += (s,)
+                        plan = [ (labels, sl + (slice(None),), shp + (s,))
+                                 for labels, sl, shp in plan ]
+                    else:
+                        pop_sizes = [int(psize) for psize in s.split('+')]
+                        offsets = np.cumsum([0] + pop_sizes)
+                        out_shape += (offsets[-1],)
+                        plan = [ (labels + (pop,),
+                                  sl + (slice(start, stop),),
+                                  shp + (stop - start,))
+                                 for labels, sl, shp in plan
+                                 for pop, start, stop
+                                 in zip(popnames, offsets[:-1], offsets[1:]) ]
+                # Replace labels by the population samplers, so that their
+                # parameters are only retrieved once
+                plan = [ (pop_samplers[key(*labels)], sl, shp)
+                         for labels, sl, shp in plan ]
                 def get_sample():
                     logger.debug("Getting {} sample.".format(self.name))
-                    return np.block(
-                        [ [ pop_samplers[key(pop1, pop2)](shapes[i + j])
-                            for pop2, j in zip(popnames, range(0, n**1, n**0)) ]
-                          for pop1, i in zip(popnames, range(0, n**2, n**1)) ] )
+                    out = np.empty(out_shape)
+                    for sample_pop, sl, shp in plan:
+                        out[sl] = sample_pop(shp)
+                    return out
+                def get_batch(n):
+                    # Draw each block for all samples with a single call
+                    # to the RNG
+                    logger.debug("Getting {} {} samples.".format(n, self.name))
+                    batch = np.empty((n,) + out_shape)
+                    for sample_pop, sl, shp in plan:
+                        batch[(slice(None),) + sl] = sample_pop((n,) + shp)
+                    return batch
             else:
                 raise NotImplementedError("Population samplers for block-broadcastable "
                                           "pattern '{}' are not yet implemented."
                                           .format(pop_pattern))
 
+        # `get_batch(n)` returns either a list of samples, or an array with
+        # samples along the first axis
+        if get_batch is None:
+            # Fall back to drawing samples one at a time
+            def get_batch(n):
+                return [get_sample() for i in range(n)]
+
         if isinstance(desc, ParameterSetBase) and 'transform' in desc:
             inverse = Transform(desc.transform.back)
             self._get_sample = lambda : inverse(get_sample())
+            self._get_batch = lambda n: [inverse(_batch_item(batch, i))
+                                         for batch in (get_batch(n),)
+                                         for i in range(n)]
         else:
             self._get_sample = get_sample
+            self._get_batch = get_batch
+        self.batch_size = batch_size
         self._cache = deque()
+            # Batches of samples which haven't been returned yet
+        self._cache_idx = 0
+            # Index of the next sample to return in the first cached batch
         self.name = name # Not actually used, but useful e.g. for debugging
+        if self.sampled_idx is None:
+            # Choose the sampling method once, rather than on every call
+            self._sample = self._sample_fixed
 
     # =======
     class PopSampler:
         """Retrieval interface for the different block samplers in ParameterSampler"""
-        def __init__(self, distparams, popnames):
+        # Supported distributions, as
+        # (RNG method, names of its positional parameters, output function)
+        _distributions = {
+            'normal':      ('normal', ('loc', 'scale'), None),
+            'expnormal':   ('normal', ('loc', 'scale'), np.exp),
+            'exponential': ('exponential', ('scale',), None),
+            'exp':         ('exponential', ('scale',), None),
+            'gamma':       ('gamma', ('a', 'scale'), None)
+        }
+
+        def __init__(self, distparams, popnames, rng):
             self.distparams = distparams
-            self.key = None
             self.popnames = popnames
+            self.rng = rng
+            self._pop_values = {}
+                # Per-population values returned by __getattr__, by attribute
+            self._resolved = {}
+                # Parameters of each population, by population key
 
         def __getitem__(self, key):
-            self.key = key    # Used in __getattr__
-            if self.dist == 'normal':
-                def _sample_pop(size):
-                    return np.random.normal(self.loc, self.scale, size=size)
-            elif self.dist == 'expnormal':
-                def _sample_pop(size):
-                    return np.exp(np.random.normal(self.loc, self.scale,
-                                                   size=size))
-            elif self.dist in ['exponential', 'exp']:
-                def _sample_pop(size):
-                    return np.random.exponential(self.scale, size=size)
-            elif self.dist == 'gamma':
-                def _sample_pop(size):
-                    return np.random.gamma(shape=self.a, scale=self.scale,
-                                           size=size)
-            else:
+            # Parameters are retrieved once here and bound in the returned
+            # function, so that sampling doesn't need to look them up.
+            get = lambda attr: self._get_pop_param(key, attr)
+            dist = get('dist')
+            factor = get('factor')
+            if dist not in self._distributions:
                 raise ValueError("Unrecognized distribution type '{}'."
                                 .format(self.distparams.dist))
+            method, argnames, output = self._distributions[dist]
+            draw = functools.partial(getattr(self.rng, method),
+                                     *(get(attr) for attr in argnames))
+            if output is None:
+                _sample_pop = draw
+            else:
+                def _sample_pop(size):
+                    return output(draw(size))
 
-            def sample_pop(size):
-                self.key = key    # Used in __getattr__
-                res = _sample_pop(size)
-                factor = self.factor
-                if factor is not None:
+            if factor is None:
+                return _sample_pop
+            else:
+                def sample_pop(size):
+                    res = _sample_pop(size)
                     res *= factor
-                self.key = None
-                return res
-
-            self.key = None
-            return sample_pop
-
-        # Retrieve the population-specific
-        # parameter, or fall back to the global one if the first
-        # isn't given
+                    return res
+                return sample_pop
+
+        def _has_output(self, key):
+            # Return True if draws for population `key` are passed through
+            # an output function
+            dist = self._get_pop_param(key, 'dist')
+            return (dist in self._distributions
+                    and self._distributions[dist][2] is not None)
+
+        def _get_pop_param(self, key, attr):
+            # Retrieve the population-specific parameter, or fall back to
+            # the global one if the first isn't given
+            return self._resolved_params(key).get(attr)
+
+        def _resolved_params(self, key):
+            # Return a dictionary merging the global and population-specific
+            # parameters; it is computed once per population
+            params = self._resolved.get(key)
+            if params is None:
+                params = dict(self.distparams)
+                if key is not NoPops:
+                    params.update(self.distparams[key])
+                self._resolved[key] = params
+            return params
+
+        # Return a value for each population
         def __getattr__(self, attr):
-            if self.key is None:
-                # Not called from within __getitem__: return a value
-                # for each population
-                if self.popnames is not None:
-                    return [self.distparams
-                              .get(α, self.distparams)
-                              .get(attr, getattr(self.distparams, attr, None))
-                             for α in self.popnames]
-                else:
-                    return getattr(self.distparams, attr)
-
-            elif self.key is not NoPops and attr in self.distparams[self.key]:
-                return getattr(self.distparams[self.key], attr)
+            if attr.startswith('__') or attr in ('distparams', 'popnames',
+                                                 '_pop_values', '_resolved'):
+                # Don't resolve special or not yet set attributes
+                # (e.g. during copy or unpickling)
+                raise AttributeError(attr)
+            if self.popnames is not None:
+                values = self._pop_values.get(attr)
+                if values is None:
+                    values = self._pop_values[attr] = tuple(
+                        self._resolved_params(α if α in self.distparams
+                                              else NoPops).get(attr)
+                        for α in self.popnames)
+                return list(values)  # Return a copy, which can be modified
             else:
-                return getattr(self.distparams, attr, None)
+                return getattr(self.distparams, attr)
     # =======
 
+    def _reset(self):
+        # Discard cached samples; used by `ParameterSetSampler.reset`
+        self._cache.clear()
+        self._cache_idx = 0
+        if self.sampled_idx is not None:
+            self.sampled_idx = 0
+
     def __call__(self):
         if len(self._cache) == 0:
             self._sample()
-        return self._cache.popleft()
-
-    def _sample(self, sample_i=None):
-        if self.sampled_idx is None:
-            self._cache.append(self._get_sample())
-        else:
-            if sample_i is None:
-                sample_i = self.sampled_idx + 1
-            if sample_i > self.sampled_idx:
-                while self.previous.sampled_idx < sample_i + self.previous_offset:
-                    self.previous._sample(sample_i + self.previous_offset)
-                self.sampled_idx += 1
-                self._cache.append(self._get_sample())
-            else:
-                pass
-                #assert(len(self._cache) > 0)
-
-    @property
-    def previous(self):
-        if self._previous.sampled_idx is None:
-            return self._previous.previous
-        else:
-            return self._previous
-
-    @property
-    def previous_offset(self):
-        if self._previous.sampled_idx is None:
-            # Add the previous sampler's offset, since it's skipped over
-            return self._previous_offset + self._previous.previous_offset
-        else:
-            return self._previous_offset
-
-    def set_previous(self, previous_sampler, offset):
-        """Set the previous ParameterSampler in the chain."""
-        if offset > 0:
-            raise ValueError("Offset cannot be positive.")
-        if offset not in [0, -1]:
-            logger.warning("ParameterSampler index offsets are usually either 0 or -1. "
-                           "You specified {}.".format(offset))
-        self._previous = previous_sampler
-        self._previous_offset = offset
+        # Take samples out of the cached batch one at a time, rather than
+        # splitting batches into individual samples when they are drawn
+        batch = self._cache[0]
+        sample = _batch_item(batch, self._cache_idx)
+        self._cache_idx += 1
+        if self._cache_idx == len(batch):
+            self._cache.popleft()
+            self._cache_idx = 0
+        return sample
+
+    def _sample(self):
+        self.sampled_idx += 1
+        self._cache.append(self._get_batch(self.batch_size))
+
+    def _sample_fixed(self):
+        # Replaces `_sample` for fixed values (see __init__)
+        self._cache.append((self._get_sample(),))
@@ -1020,10 +1020,11 @@ class RecordListSummary(OrderedDict):
         if isinstance(parameters, str):
             parameters = (parameters,)
         fields += tuple('parameters.' + p for p in parameters)
-        for lbl, sr in self.items():
-            entry = tuple(combine(sr, field) for field in fields)
-            entry = (len(sr),) + entry
-            data.append(entry)
+        with ml.parameters.digest_cache():
+            for lbl, sr in self.items():
+                entry = tuple(combine(sr, field) for field in fields)
+                entry = (len(sr),) + entry
+                data.append(entry)
         data = np.array(data)
 
         fieldnames = tuple(format_field(field) for field in fields)
@@ -110,8 +110,12 @@ def strip_comments(s, comment_mark='#'):
     Searches for `comment_mark` and removes everything follows,
     up to but excluding the next newline.
     """
-    return '\n'.join(line.partition(comment_mark)[0].rstrip()
-                     for line in s.splitlines())
+    # Joining a list is faster than joining a generator, since `join` needs
+    # to materialize its argument anyway.
+    if comment_mark not in s:
+        return '\n'.join([line.rstrip() for line in s.splitlines()])
+    return '\n'.join([line.partition(comment_mark)[0].rstrip()
+                      for line in s.splitlines()])
 
 def stablehash(o):
     """
@@ -172,36 +176,76 @@ def int_if_close(x, tol=100, npint=None, allow_power10=True):
     -------
     out : int | float
     """
-    from numbers import Number, Integral, Real
+    # Dispatch on the exact type of `x`. Types without a specialized
+    # implementation use the generic one below.
+    impl = _int_if_close_impls.get(type(x))
+    if impl is not None:
+        return impl(x, tol, npint, allow_power10)
+
+    from numbers import Integral
     import numpy as np
 
     if npint is None: npint = np.int64
     if ( isinstance(x, Integral)
          or (hasattr(x, 'dtype') and np.issubdtype(x.dtype, np.integer)) ):
         return x
-        #pass
     if isinstance(x, np.ndarray):
-        cond = (abs(x - np.rint(x)) < tol * np.finfo(x.dtype.type).eps).all()
-    else:
-        cond = abs(x - np.rint(x)) < tol * np.finfo(x).eps
-    if cond:
-        if isinstance(x, (np.ndarray, np.number)):
-            #return np.rint(x).astype(npint)
-            x = np.rint(x).astype(npint)
+        # NumPy is now imported, so the array implementation can be registered
+        _int_if_close_impls[np.ndarray] = _int_if_close_array
+        return _int_if_close_array(x, tol, npint, allow_power10)
+    rounded = np.rint(x)
+    if abs(x - rounded) < tol * np.finfo(x).eps:
+        if isinstance(x, np.number):
+            x = rounded.astype(npint)
         else:
-            #return int(round(x))
             x = int(round(x))
+    return _int_if_close_power10(x, tol, npint, allow_power10)
+
+def _int_if_close_identity(x, tol, npint, allow_power10):
+    return x
+
+def _int_if_close_float(x, tol, npint, allow_power10):
+    # Plain floats are rounded without NumPy.
+    # `round` rounds half to even, like `np.rint`, but fails on nan and inf
+    import sys
+    if x - x == 0:  # Finite
+        rounded = round(x)
+        if abs(x - rounded) < tol * sys.float_info.epsilon:
+            x = rounded
+    return _int_if_close_power10(x, tol, npint, allow_power10)
+
+def _int_if_close_array(x, tol, npint, allow_power10):
+    import numpy as np
+    if npint is None: npint = np.int64
+    if np.issubdtype(x.dtype, np.integer):
+        return x
+    # Round once, and compute the distance in place to avoid allocating
+    # more temporary arrays
+    rounded = np.rint(x)
+    dist = x - rounded
+    if dist.ndim > 0:
+        np.abs(dist, out=dist)
     else:
-        #return x
-        pass
+        dist = abs(dist)  # 0-dim arrays give scalars
+    if (dist < tol * np.finfo(x.dtype.type).eps).all():
+        x = rounded.astype(npint)
+    return _int_if_close_power10(x, tol, npint, allow_power10)
 
+def _int_if_close_power10(x, tol, npint, allow_power10):
+    # Second step of `int_if_close`: try to round to a power of 10
     if allow_power10:
+        from numbers import Integral
+        import numpy as np
         pwr = int_if_close(np.log10(x), tol, npint, allow_power10=False)
         if isinstance(pwr, Integral):
             x = 10**int(pwr)   # Need `int()` b/c numpy doesn't allow neg. pwr
-
     return x
 
+_int_if_close_impls = {int: _int_if_close_identity,
+                       bool: _int_if_close_identity,
+                       float: _int_if_close_float}
+    # Implementations of `int_if_close`, by exact input type
+
 def less_close(x1, x2, rtol=1e-5, atol=1e-8):
     """
     'less than or equal' test where 'isclose' is used to test
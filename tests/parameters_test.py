@@ -5,6 +5,7 @@ Created on Wed Sep 20 15:53:49 2017
 @author: alex
 """
 
+import sys
 import numpy as np
 from collections import OrderedDict
 from parameters import ParameterSet
@@ -37,6 +38,56 @@ def expansion_test():
     assert( ml.parameters.expand_params(input_str) == target_output )
 
 
+def expansion_nested_test():
+    # Nested blocks, and multiple blocks in one string
+    assert(ml.parameters.expand_params("{a: *[1, *{2, 3}], b: *[x, y]}")
+           == ['{a: 1, b: x}', '{a: 1, b:  y}',
+               '{a:  2, b: x}', '{a:  2, b:  y}',
+               '{a:   3, b: x}', '{a:   3, b:  y}'])
+    assert(ml.parameters.expand_params("{a: *[[1, 2], *[3, 4]], b: *{5}}")
+           == ['{a: [1, 2], b: 5}', '{a:  3, b: 5}', '{a:   4, b: 5}'])
+    assert(ml.parameters.expand_params("{a: [1, 2]}") == ["{a: [1, 2]}"])
+
+def expansion_unexpanded_test():
+    for s in ("{a: 1 * 2, b: *[1, 2]}", "{a: [*, 1]}"):
+        # By default, expansion characters without a block are ignored
+        assert(len(ml.parameters.expand_params(s)) == (2 if 'b' in s else 1))
+        try:
+            ml.parameters.expand_params(s, fail_on_unexpanded=True)
+        except ValueError:
+            pass
+        else:
+            assert(False)
+
+def expand_urls_test():
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = {'a': "{'x': 1,  # comment\n 'y': 2}\n",
+                 'b': "[3, 4]",  # No trailing newline
+                 'c': "{'b': url(B),\n 'c': 5}\n\n\n"}
+        paths = {name: os.path.join(tmpdir, name + '.txt') for name in files}
+        for name, content in files.items():
+            with open(paths[name], 'w') as f:
+                f.write(content.replace('B', paths['b']))
+        def expand(s):
+            for name, path in paths.items():
+                s = s.replace(name.upper(), path)
+            return ml.parameters.expand_urls(s)
+        # Multiple urls, quoted or not
+        assert(expand("{'p': url(A), 'q': url('B')}\n")
+               == "{'p': {'x': 1,\n 'y': 2}, 'q': [3, 4]}")
+        # Url at the end of the file; trailing newlines are stripped as if
+        # comments were removed once per expanded url
+        assert(expand("url(A)\n\n\n\n") == "{'x': 1,\n 'y': 2}\n\n")
+        assert(expand("{'p': url(B)}\n\n\n\n\n") == "{'p': [3, 4]}\n\n\n")
+        # Nested urls, and a file expanded twice
+        assert(expand("{'n': url(C), 'm': url(C)}\n\n\n")
+               == "{'n': {'b': [3, 4],\n 'c': 5}\n\n, "
+                  "'m': {'b': [3, 4],\n 'c': 5}\n\n}")
+        # Commented out urls are not expanded
+        assert(expand("x # url(/nonexistent)\n") == "x")
+
 def filename_test():
     params = ParameterSet({
         "seed": 100,
@@ -64,5 +115,264 @@ def filename_test():
         print(repr(sorted_params))
         #basename = hashlib.sha1(bytes(repr(sorted_params), 'utf-8')).hexdigest()
 
+def filename_bytes_test():
+    params = ParameterSet({
+        "seed": 100,
+        "N": [500, 100],
+        "p": [[0.1009, 0.1689],
+              [0.1346, 0.1371]],
+        "_ignored": 1
+        })
+    params2 = ParameterSet({
+        "seed": 100,
+        "N": np.array([500, 100]),
+        "p": np.array([[0.1009, 0.1689],
+                       [0.1346, 0.1371]]),
+        "_ignored": 2
+        })
+    name = ml.parameters.get_filename(params, legacy=False)
+    assert(len(name) == 40)
+    assert(name == ml.parameters.get_filename(params2, legacy=False))
+    assert(name != ml.parameters.get_filename(params2))
+    params2['N'] = np.array([500, 101])
+    assert(name != ml.parameters.get_filename(params2, legacy=False))
+
+def filename_bytes_scalar_test():
+    # NumPy scalars hash like the equivalent Python scalars, so that names
+    # don't depend on the NumPy version
+    params = ParameterSet({"a": 0.1, "b": 3, "c": {"d": True}})
+    params2 = ParameterSet({"a": np.float64(0.1), "b": np.int64(3),
+                            "c": {"d": np.bool_(True)}})
+    for convert in (True, False):
+        name = ml.parameters.get_filename(params, legacy=False,
+                                          convert_to_arrays=convert)
+        assert(name == ml.parameters.get_filename(params2, legacy=False,
+                                                  convert_to_arrays=convert))
+
+def filenames_test():
+    params = [ParameterSet({"seed": 100, "N": [500, i]}) for i in range(3)]
+    names = ml.parameters.get_filenames(params, ['a', 'b', 'c'])
+    assert(names == [ml.parameters.get_filename(p, s)
+                     for p, s in zip(params, ['a', 'b', 'c'])])
+
+def filename_hasher_test():
+    base = ParameterSet({"seed": 100, "N": [500, 100]})
+    hasher = ml.parameters.digest_hasher(base)
+    name1 = ml.parameters.digest_from_hasher(hasher, ParameterSet({"p": 0.1}))
+    name2 = ml.parameters.digest_from_hasher(hasher, ParameterSet({"p": 0.2}))
+    assert(name1 != name2)
+    assert(name1 == ml.parameters.digest_from_hasher(hasher,
+                                                     ParameterSet({"p": 0.1})))
+    assert(ml.parameters.digest_from_hasher(hasher, ParameterSet({"p": 0.1}), 'x')
+           == name1 + '_x')
+
+def prune_test():
+    params = ParameterSet({'a': {'b': {'c': [1], 'd': [2]}, 'e': [3]},
+                           'f': [4]})
+    pruned = ml.parameters.prune(params, ['a.b.c', 'f'])
+    assert(pruned == {'a': {'b': {'c': [1]}}, 'f': [4]})
+    assert(ml.parameters.prune(params, 'a.b', exclude='a.b.d')
+           == {'a': {'b': {'c': [1]}}})
+    # Duplicate and overlapping nested filters; the shortest prefix wins
+    target = {'a': {'b': {'c': [1], 'd': [2]}}}
+    for keep in (['a.b', 'a.b'], ['a.b.c', 'a.b'], ['a.b', 'a.b.c']):
+        assert(ml.parameters.prune(params, keep) == target)
+    assert(ml.parameters.prune(params, ['a', 'a.e', 'f'])
+           == {'a': params['a'], 'f': [4]})
+    # Top-level parameters kept twice are almost certainly an error
+    for keep in (['f', 'f'], ['a.e', 'a']):
+        try:
+            ml.parameters.prune(params, keep)
+        except ValueError:
+            pass
+        else:
+            assert(False)
+    # Filters which match nothing are ignored
+    assert(ml.parameters.prune(params, ['zz', 'a.zz', 'a.b.zz', 'f'])
+           == {'f': [4]})
+
+def differing_keys_test():
+    def differing_keys(*psets):
+        recs = ml.parameters.make_paramrecs(
+            psets, ['r' + str(i) for i in range(len(psets))])
+        return sorted(ml.parameters.get_differing_keys(recs))
+    p1 = ParameterSet({'a': 1, 'b': {'c': 1, 'd': 'x'}, 'h': [1, 2],
+                       'k': np.array([1., 2.])})
+    p2 = ParameterSet({'a': 1, 'b': {'c': 2, 'd': 'x'}, 'g': 1, 'h': [1, 2],
+                       'k': np.array([1., 2.])})
+    p3 = ParameterSet({'a': 1, 'b': {'c': 1, 'd': 'y'}, 'h': [1, 3],
+                       'k': np.array([1., 2.5])})
+    assert(differing_keys(p1, p1) == [])
+    assert(differing_keys(p1, p2) == ['b.c', 'g'])
+    assert(differing_keys(p1, p2, p3) == ['b.c', 'b.d', 'g', 'h', 'k'])
+    assert(differing_keys(ParameterSet({'a': 1}), ParameterSet({'a': 1.}))
+           == ['a'])
+    # A nested set in some records only
+    assert(differing_keys(ParameterSet({'a': 1, 'e': {'f': 1}}),
+                          ParameterSet({'a': 1, 'e': 3})) == ['e'])
+    # Arrays which only compare equal by broadcasting differ
+    assert(differing_keys(ParameterSet({'a': np.array([1., 1.])}),
+                          ParameterSet({'a': np.array([1.])})) == ['a'])
+    assert(differing_keys(ParameterSet({'a': np.array([[1.], [1.]])}),
+                          ParameterSet({'a': np.array([1., 1.])})) == ['a'])
+
+def transform_unsupported_test():
+    import simpleeval
+    # Compiled transforms must evaluate and reject the same constructs as
+    # simpleeval, which for example looks up attributes as keys first
+    assert(ml.parameters.Transform('x -> x.key')({'key': 3}) == 3)
+    for desc in ['x -> (x, 2)', 'x -> [x][0]', 'x -> np.func_foo']:
+        try:
+            ml.parameters.Transform(desc)(1)
+        except simpleeval.FeatureNotAvailable:
+            pass
+        else:
+            assert(False)
+
+def transform_immutable_test():
+    T = ml.parameters.Transform('x -> 2*x')
+    assert(T is ml.parameters.Transform('x -> 2*x'))
+    for attr in ('xname', 'expr'):
+        try:
+            setattr(T, attr, 'y')
+        except AttributeError:
+            pass
+        else:
+            assert(False)
+    assert(T(3) == 6)
+
+def transform_deepcopy_test():
+    import copy
+    T = ml.parameters.Transform('x -> np.log10(x)')
+    T2 = copy.deepcopy(T)
+    assert(T2.desc == T.desc)
+    assert(T2(100.) == T(100.) == 2.)
+    assert(ml.parameters.Transform.namespaces['np'] is np)
+
+def transform_pickle_test():
+    import copy
+    import pickle
+    desc = ParameterSet({'name': 'x -> logx',
+                         'to': 'x -> np.log10(x)',
+                         'back': 'logx -> 10**logx'})
+    T = ml.parameters.Transform(desc.to)
+    for T2 in (pickle.loads(pickle.dumps(T)), copy.deepcopy(T)):
+        assert(T2.desc == T.desc)
+        assert(T2(100.) == 2.)
+    var = ml.parameters.TransformedVar(desc, orig=100.)
+    novar = ml.parameters.TransformedVar(None, orig=3.)
+    for var2 in (pickle.loads(pickle.dumps(var)), copy.deepcopy(var)):
+        assert(var2.names == ('x', 'logx'))
+        assert(var2.orig == 100. and var2.new == 2.)
+        assert(var2.back(var2.new) == 100.)
+    for novar2 in (pickle.loads(pickle.dumps(novar)), copy.deepcopy(novar)):
+        assert(novar2.names is None)
+        assert(novar2.to(novar2.orig) == 3.)
+
+def transform_threads_test():
+    from concurrent.futures import ThreadPoolExecutor
+    T = ml.parameters.Transform('y -> (y - 1)/2')
+    Tnp = ml.parameters.Transform('y -> np.log10(y)')
+    assert(T is ml.parameters.Transform('y -> (y - 1)/2'))
+    xs = list(range(1, 2001))
+    def apply(x):
+        return T(x), Tnp(x)
+    # Switch threads as often as possible, to make interleaved calls likely
+    switchinterval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(apply, xs))
+    finally:
+        sys.setswitchinterval(switchinterval)
+    assert(results == [((x - 1)/2, np.log10(x)) for x in xs])
+
+def sampler_spawn_threads_test():
+    from concurrent.futures import ThreadPoolExecutor
+    dists = ParameterSet({
+        'x': {'dist': 'normal', 'shape': (2,), 'loc': 0., 'scale': 1.,
+              'transform': {'name': 'x -> logx', 'to': 'x -> np.log10(x)',
+                            'back': 'logx -> 10**logx'}},
+        'y': {'dist': 'gamma', 'shape': (3,), 'a': 2., 'scale': 1.,
+              'transform': {'name': 'y -> z', 'to': 'y -> (y - 1)/2',
+                            'back': 'z -> 2*z + 1'}}})
+    def draw(sampler):
+        return [sampler.sample() for i in range(200)]
+    def spawn():
+        return ml.parameters.ParameterSetSampler(dists, seed=5).spawn(8)
+    serial = [draw(sampler) for sampler in spawn()]
+    switchinterval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            threaded = list(executor.map(draw, spawn()))
+    finally:
+        sys.setswitchinterval(switchinterval)
+    for draws1, draws2 in zip(serial, threaded):
+        for p1, p2 in zip(draws1, draws2):
+            assert(np.all(p1.x == p2.x) and np.all(p1.y == p2.y))
+    # Spawned samplers draw different values
+    assert(not np.all(serial[0][0].y == serial[1][0].y))
+
+def sampler_batch_test():
+    dists = ParameterSet({'seed': 7, 'populations': ['a', 'b'],
+        'x': {'dist': 'normal', 'shape': (2,), 'loc': 0., 'scale': 1.},
+        'y': {'dist': 'gamma', 'shape': (1,), 'a': 2., 'scale': 1.},
+        'p': {'dist': 'normal', 'shape': ('2+3',), 'loc': 0., 'scale': 1.,
+              'a': {'loc': 5.}, 'b': {}},
+        'f': [1, 2]})
+    global_state = np.random.get_state()
+    for batch_size in (1, 3, 10):
+        # Draws don't depend on the order in which variables are requested
+        S1 = ml.parameters.ParameterSetSampler(dists, batch_size=batch_size)
+        S2 = ml.parameters.ParameterSetSampler(dists, batch_size=batch_size)
+        draws1 = [S1.sample() for i in range(7)]
+        draws2 = {name: [S2.sample(name) for i in range(7)]
+                  for name in ['p', 'f', 'y', 'x']}
+        for i, params in enumerate(draws1):
+            for name in ['x', 'y', 'p', 'f']:
+                assert(np.all(params[name] == draws2[name][i]))
+        # With a single sampled variable, draws don't depend on batch size
+        Sx = ml.parameters.ParameterSetSampler(
+            ParameterSet({'seed': 7, 'x': dists['x']}), batch_size=batch_size)
+        xs = np.array([Sx.sample('x') for i in range(7)])
+        if batch_size == 1:
+            xs_ref = xs
+        assert(np.all(xs == xs_ref))
+    # Sampling doesn't touch the global RNG, whether or not a seed is given
+    del dists['seed']
+    S4 = ml.parameters.ParameterSetSampler(dists, batch_size=3)
+    S4.sample(); S4.sample('y')
+    new_state = np.random.get_state()
+    assert(all(np.all(s1 == s2) for s1, s2 in zip(global_state, new_state)))
+
+def sampler_scalar_test():
+    # Scalar samples have the same type as when drawn one at a time:
+    # `np.exp` returns scalars, while the RNG returns 0-dim arrays
+    dists = ParameterSet({'seed': 4,
+        'w': {'dist': 'expnormal', 'shape': (), 'loc': 0., 'scale': 1.}})
+    rng = np.random.RandomState(4)
+    ws = [np.exp(rng.normal(0., 1., size=())) for i in range(5)]
+    for batch_size in (1, 2, 5):
+        sampler = ml.parameters.ParameterSetSampler(dists, batch_size=batch_size)
+        for w in ws:
+            sample = sampler.sample('w')
+            assert(type(sample) is np.float64 and sample == w)
+    dists.w.dist = 'normal'
+    sampler = ml.parameters.ParameterSetSampler(dists, batch_size=3)
+    sample = sampler.sample('w')
+    assert(type(sample) is np.ndarray and sample.ndim == 0)
+    # Samples don't share memory with the rest of their batch
+    assert(sample.base is None)
+
+def sampler_rng_state_test():
+    dists = ParameterSet({'seed': 3,
+        'x': {'dist': 'normal', 'shape': (2,), 'loc': 0., 'scale': 1.}})
+    sampler = ml.parameters.ParameterSetSampler(dists)
+    state = sampler.rng_state
+    x1 = sampler.sample('x')
+    sampler.rng_state = state
+    assert(np.all(sampler.sample('x') == x1))
+
 if __name__ == '__main__':
     filename_test()